@@ -0,0 +1,37 @@
+import os
+import sys
+import timeit
+
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), '..')]
+
+from orm.query import *
+
+
+def chain(n):
+    where = Sql('c0') == 0
+    for i in xrange(1, n):
+        where = where & (Sql('c%d' % (i,)) == i)
+    return Select(Sql('*'), Sql('t'), where)
+
+
+def wide(n):
+    return Select(Sql('*'), Sql('t'), Sql('c').isin(ExprList(range(n))))
+
+
+def main():
+    number = int(sys.argv[1]) if sys.argv[1:] else 200
+    print '%-6s %8s %14s %14s' % ('tree', 'size', 'compile us', 'us/node')
+    for name, build, sizes in (
+        ('chain', chain, (10, 50, 100, 200, 400)),
+        ('wide', wide, (10, 100, 1000, 10000)),
+    ):
+        for size in sizes:
+            q = build(size)
+            n = max(number * 10 / size, 5)
+            compile_time = timeit.timeit(q.compile, number=n) / n * 1e6
+            print '%-6s %8d %14.1f %14.3f' % (
+                name, size, compile_time, compile_time / size)
+
+
+if __name__ == '__main__':
+    main()
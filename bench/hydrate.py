@@ -0,0 +1,34 @@
+import os
+import sys
+import timeit
+
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), '..')]
+
+from orm.model import *
+from orm.model import _hydrate_any
+
+
+def model(width):
+    ns = dict(orm_table='t%d' % (width,))
+    for i in xrange(width):
+        ns['c%d' % (i,)] = Column(converter=int if i % 4 == 0 else None)
+    return type('Wide%d' % (width,), (Model,), ns)
+
+
+def main():
+    rows = int(sys.argv[1]) if sys.argv[1:] else 20000
+    print '%6s %14s %14s %8s' % ('width', 'naive rows/s', 'plan rows/s', 'x')
+    for width in (2, 10, 50):
+        cls = model(width)
+        columns = tuple(cls.orm_columns)
+        data = [tuple(xrange(len(columns)))] * rows
+        hydrate = cls.find()._hydrator()
+        naive = timeit.timeit(
+            lambda: [_hydrate_any(columns, row) for row in data], number=1)
+        plan = timeit.timeit(lambda: map(hydrate, data), number=1)
+        print '%6d %14d %14d %8.1f' % (
+            width, rows / naive, rows / plan, naive / plan)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import os
+import random
+import sqlite3
+import sys
+import timeit
+
+sys.path[0:0] = [os.path.join(os.path.dirname(__file__), '..')]
+
+from orm import connection
+from orm.query import *
+
+
+def setup(rows):
+    db = connection.connect(':memory:')
+    db.execute('create table t (id integer primary key, v text)')
+    db.executemany(
+        'insert into t values (?, ?)', ((i, str(i)) for i in xrange(rows)))
+    db.commit()
+
+
+def run(values, strategy):
+    q = Select(Sql('count(*)'), Sql('t'), Sql('id').isin(
+        InList(values, strategy)))
+    return q.execute().fetchone()[0]
+
+
+def main():
+    rows = int(sys.argv[1]) if sys.argv[1:] else 100000
+    setup(rows)
+    strategies = ('expand', 'bucket', 'json')
+    print '%8s' % ('values',) + ''.join('%12s' % (s,) for s in strategies)
+    for size in (4, 16, 64, 256, 1024, 4096, 16384, 65536):
+        # vary the length a little, the way real id lists do
+        lists = [
+            random.sample(xrange(rows), size - i % 3)
+            for i in xrange(max(4096 / size, 3))
+        ]
+        line = '%8d' % (size,)
+        for strategy in strategies:
+            try:
+                t = timeit.timeit(
+                    lambda: [run(values, strategy) for values in lists],
+                    number=1)
+            except sqlite3.OperationalError:
+                line += '%12s' % ('-',)
+                continue
+            line += '%12.1f' % (t / len(lists) * 1e6,)
+        print line
+    print '(microseconds per query; - means too many SQL variables)'
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,14 @@
 import sqlite3
 import threading
+import time
+import weakref
+from contextlib import contextmanager
 
 
 def reset():
-    global state
+    global state, pool
     state = threading.local()
+    pool = None
 
 reset()
 
@@ -15,9 +19,361 @@ def connect(*args, **kwargs):
     return connection
 
 
+def set_pool(new_pool):
+    global pool
+    pool = new_pool
+    return new_pool
+
+
 def get_connection():
     global state
     try:
         return state.connection
     except AttributeError:
+        if pool is None:
+            raise RuntimeError('not connected')
+    return pool.lease()
+
+
+def release():
+    if pool is not None:
+        pool.release()
+
+
+def execute(sql, args=(), readonly=False):
+    if readonly and getattr(state, 'connection', None) is None:
+        if pool is None:
+            raise RuntimeError('not connected')
+        return pool.execute(sql, args)
+    with borrow(readonly) as connection:
+        cur = connection.cursor()
+        cur.execute(sql, args)
+    return cur
+
+
+def executemany(sql, args, readonly=False):
+    with borrow(readonly) as connection:
+        cur = connection.cursor()
+        cur.executemany(sql, args)
+    return cur
+
+
+@contextmanager
+def borrow(readonly=False):
+    connection = getattr(state, 'connection', None)
+    if connection is not None:
+        yield connection
+        return
+    if pool is None:
+        raise RuntimeError('not connected')
+    with pool.borrow(readonly) as connection:
+        yield connection
+
+
+@contextmanager
+def transaction():
+    connection = getattr(state, 'connection', None)
+    if connection is not None:
+        state.transactions = getattr(state, 'transactions', 0) + 1
+        try:
+            with connection:
+                yield connection
+        finally:
+            state.transactions -= 1
+        return
+    if pool is None:
         raise RuntimeError('not connected')
+    with pool.transaction() as connection:
+        yield connection
+
+
+def writing():
+    # whether this thread is in a transaction, or holds the connection
+    # that writes go through; a write handed to another thread would then
+    # wait on this one
+    if getattr(state, 'connection', None) is not None:
+        return bool(getattr(state, 'transactions', 0))
+    return pool is not None and pool.writing()
+
+
+class _Lease(object):
+    # a pooled connection shared by everything on one thread that uses it:
+    # live cursors, connection() blocks and an explicit lease(); it goes
+    # back to the pool when the last of them lets go
+    def __init__(self, pool, connection):
+        self.pool = pool
+        self.connection = connection
+        self.refs = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            self.refs += 1
+
+    def release(self):
+        with self._lock:
+            self.refs -= 1
+            if self.refs:
+                return
+            connection, self.connection = self.connection, None
+        if connection is not None:
+            self.pool.checkin(connection)
+
+
+class _Hold(object):
+    def __init__(self, lease):
+        self.lease = lease
+        lease.acquire()
+
+    def close(self):
+        lease, self.lease = self.lease, None
+        if lease is not None:
+            lease.release()
+
+    # holds live in a thread-local or on a cursor, so a thread that exits
+    # without calling release(), or a cursor that is dropped, still lets go
+    __del__ = close
+
+
+class _Cursor(sqlite3.Cursor):
+    hold = None
+
+
+class Pool(object):
+    def __init__(self, *args, **kwargs):
+        self.max_size = kwargs.pop('max_size', 5)
+        # how long checkout() waits for a free connection; timeout itself
+        # is sqlite3.connect()'s busy timeout
+        self.checkout_timeout = kwargs.pop('checkout_timeout', None)
+        self.max_idle = kwargs.pop('max_idle', None)
+        self.check = kwargs.pop('check', False)
+        self.setup = list(kwargs.pop('setup', ()))
+        kwargs.setdefault('check_same_thread', False)
+        self.args = args
+        self.kwargs = kwargs
+        self.size = 0
+        self.idle = []
+        self.stats = dict(
+            connects=0, checkouts=0, checkins=0,
+            waits=0, wait_time=0.0, evictions=0, failed_checks=0,
+        )
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def _connect(self):
+        connection = sqlite3.connect(*self.args, **self.kwargs)
+        for hook in self.setup:
+            hook(connection)
+        return connection
+
+    def _ping(self, connection):
+        try:
+            connection.cursor().execute('select 1')
+        except sqlite3.Error:
+            return False
+        return True
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except sqlite3.Error:
+            pass
+
+    def _evict(self):
+        if self.max_idle is None:
+            return
+        cutoff = time.time() - self.max_idle
+        while self.idle and self.idle[0][1] <= cutoff:
+            connection, checked_in = self.idle.pop(0)
+            self.size -= 1
+            self.stats['evictions'] += 1
+            self._discard(connection)
+
+    def checkout(self, timeout=None):
+        if timeout is None:
+            timeout = self.checkout_timeout
+        with self._cond:
+            self._evict()
+            if not self.idle and self.size >= self.max_size:
+                self.stats['waits'] += 1
+                start = time.time()
+                while not self.idle and self.size >= self.max_size:
+                    remaining = None
+                    if timeout is not None:
+                        remaining = start + timeout - time.time()
+                        if remaining <= 0:
+                            self.stats['wait_time'] += time.time() - start
+                            raise RuntimeError(
+                                'timed out waiting for a connection')
+                    self._cond.wait(remaining)
+                self.stats['wait_time'] += time.time() - start
+            self.stats['checkouts'] += 1
+            if self.idle:
+                # most recently used first, so that the rest can go idle
+                connection = self.idle.pop()[0]
+            else:
+                connection = None
+                self.size += 1
+        if connection is not None:
+            if not self.check or self._ping(connection):
+                return connection
+            self.stats['failed_checks'] += 1
+            self._discard(connection)
+        try:
+            connection = self._connect()
+        except Exception:
+            with self._cond:
+                self.size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.stats['connects'] += 1
+        return connection
+
+    def checkin(self, connection):
+        try:
+            connection.rollback()
+        except sqlite3.Error:
+            self._discard(connection)
+            connection = None
+        with self._cond:
+            self.stats['checkins'] += 1
+            if connection is None:
+                self.size -= 1
+            else:
+                self.idle.append((connection, time.time()))
+            self._evict()
+            self._cond.notify()
+
+    def _lease(self, timeout=None):
+        # the thread-local only refers to the lease weakly, so that it
+        # doesn't outlive the holds that keep it checked out
+        ref = self._local.__dict__.get('lease')
+        lease = ref and ref()
+        if lease is None or lease.connection is None:
+            lease = _Lease(self, self.checkout(timeout))
+            self._local.lease = weakref.ref(lease)
+        return lease
+
+    def leased(self):
+        ref = self._local.__dict__.get('lease')
+        lease = ref and ref()
+        if lease is not None:
+            return lease.connection
+
+    def lease(self):
+        hold = self._local.__dict__.get('hold')
+        if hold is None:
+            self._local.hold = hold = _Hold(self._lease())
+        return hold.lease.connection
+
+    def release(self):
+        hold = self._local.__dict__.pop('hold', None)
+        if hold is not None:
+            hold.close()
+
+    def in_transaction(self):
+        return bool(self._local.__dict__.get('transactions'))
+
+    def writing(self):
+        return self.leased() is not None
+
+    @contextmanager
+    def connection(self, timeout=None):
+        hold = _Hold(self._lease(timeout))
+        try:
+            yield hold.lease.connection
+        finally:
+            hold.close()
+
+    @contextmanager
+    def borrow(self, readonly=False):
+        with self.connection() as connection:
+            yield connection
+            # an explicit lease or a transaction decides when to commit
+            if not (readonly or self.in_transaction() or
+                    'hold' in self._local.__dict__):
+                connection.commit()
+
+    def execute(self, sql, args=()):
+        hold = _Hold(self._lease())
+        try:
+            cur = hold.lease.connection.cursor(_Cursor)
+            cur.execute(sql, args)
+        except Exception:
+            hold.close()
+            raise
+        # the cursor keeps the thread's connection checked out while it is
+        # alive, and later statements on the thread share it
+        cur.hold = hold
+        return cur
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as connection:
+            local = self._local.__dict__
+            local['transactions'] = local.get('transactions', 0) + 1
+            try:
+                with connection:
+                    yield connection
+            finally:
+                local['transactions'] -= 1
+
+    def close(self):
+        with self._cond:
+            while self.idle:
+                self._discard(self.idle.pop()[0])
+                self.size -= 1
+
+
+def _query_only(connection):
+    connection.cursor().execute('pragma query_only = on')
+
+
+class Router(object):
+    def __init__(self, *args, **kwargs):
+        readers = kwargs.pop('readers', 4)
+        journal_mode = kwargs.pop('journal_mode', 'wal')
+        setup = list(kwargs.pop('setup', ()))
+        writer_setup = list(setup)
+        if journal_mode is not None:
+            writer_setup.insert(0, lambda connection: connection.cursor(
+                ).execute('pragma journal_mode = %s' % (journal_mode,)))
+        self.writer = Pool(
+            max_size=1, setup=writer_setup, *args, **kwargs)
+        self.readers = Pool(
+            max_size=readers, setup=[_query_only] + setup, *args, **kwargs)
+
+    def lease(self):
+        return self.writer.leased() or self.readers.lease()
+
+    def release(self):
+        self.readers.release()
+
+    def writing(self):
+        return self.writer.leased() is not None
+
+    def execute(self, sql, args=()):
+        if self.writer.leased() is not None:
+            # inside a write transaction: read your own writes
+            return self.writer.execute(sql, args)
+        return self.readers.execute(sql, args)
+
+    @contextmanager
+    def borrow(self, readonly=False):
+        if readonly and self.writer.leased() is None:
+            with self.readers.connection() as connection:
+                yield connection
+        else:
+            # a thread holding the writer reads its own writes
+            with self.writer.borrow(readonly) as connection:
+                yield connection
+
+    @contextmanager
+    def transaction(self):
+        with self.writer.transaction() as connection:
+            yield connection
+
+    def close(self):
+        self.writer.close()
+        self.readers.close()
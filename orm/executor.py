@@ -0,0 +1,313 @@
+import sys
+import threading
+import time
+import Queue
+from itertools import count, islice
+
+from . import connection
+
+
+class Future(object):
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def _wait(self, timeout):
+        with self._cond:
+            if not self._done:
+                self._cond.wait(timeout)
+            if not self._done:
+                raise RuntimeError('timed out waiting for result')
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+
+    def add_done_callback(self, fn):
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result, exc_info):
+        with self._cond:
+            self._result = result
+            self._exc_info = exc_info
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, []
+            self._cond.notify_all()
+        for fn in callbacks:
+            fn(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc_info):
+        self._finish(None, exc_info)
+
+
+class Executor(object):
+    def __init__(self, *args, **kwargs):
+        threads = kwargs.pop('threads', 4)
+        self.args = args
+        self.kwargs = kwargs
+        self._jobs = Queue.Queue()
+        self._threads = []
+        for i in xrange(threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        # each worker gets its own connection, or borrows from the
+        # configured pool when no connect() arguments are given; anything
+        # a job leased is handed back once it finishes, so idle workers
+        # don't hold on to pooled connections; a worker's own connection
+        # commits after every job instead
+        db = None
+        if self.args or self.kwargs:
+            db = connection.connect(*self.args, **self.kwargs)
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            future, fn, args, kwargs = job
+            try:
+                result = fn(*args, **kwargs)
+                if db is not None:
+                    db.commit()
+            except Exception:
+                exc_info = sys.exc_info()
+                if db is not None:
+                    db.rollback()
+                connection.release()
+                future.set_exception(exc_info)
+            else:
+                connection.release()
+                future.set_result(result)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        self._jobs.put((future, fn, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        for thread in self._threads:
+            self._jobs.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def fetch(self, q):
+        return self.submit(lambda: list(iter(q)))
+
+    def first(self, q):
+        def first():
+            for row in q[:1]:
+                return row
+        return self.submit(first)
+
+    def count(self, q):
+        return self.submit(len, q)
+
+    def exists(self, q):
+        return self.submit(q.exists)
+
+    def execute(self, q):
+        return self.submit(q.execute)
+
+    def save(self, obj):
+        return self.submit(obj.save)
+
+    def reload(self, obj):
+        return self.submit(obj.reload)
+
+    def delete(self, obj):
+        return self.submit(obj.delete)
+
+    def load(self, obj, attr):
+        return self.submit(getattr, obj, attr)
+
+    def stream(self, q, size=100, prefetch=2):
+        # yields a future per batch; the worker fills them in order, at most
+        # prefetch batches ahead of the one last handed out
+        slots = Queue.Queue()
+        futures = []
+        last = []
+        closed = []
+
+        def produce():
+            try:
+                rows = iter(q)
+                batch = list(islice(rows, size))
+                while True:
+                    # look one row ahead, so that a batch's future is known
+                    # to be the last one by the time it resolves
+                    more = list(islice(rows, 1))
+                    if not more:
+                        return put(batch, True)
+                    if not put(batch, False):
+                        return
+                    batch = more + list(islice(rows, size - 1))
+            except Exception:
+                future = take()
+                if future is not None:
+                    last.append(future)
+                    future.set_exception(sys.exc_info())
+
+        def take():
+            while not closed:
+                try:
+                    return slots.get(timeout=0.1)
+                except Queue.Empty:
+                    continue
+
+        def put(batch, end):
+            future = take()
+            if future is None:
+                return False
+            if end:
+                last.append(future)
+            future.set_result(batch)
+            return True
+
+        def want(n):
+            while len(futures) < n:
+                future = Future()
+                futures.append(future)
+                slots.put(future)
+
+        self.submit(produce)
+        try:
+            for i in count():
+                want(i + max(prefetch, 1))
+                future = futures[i]
+                yield future
+                future.exception()
+                if last and last[0] is future:
+                    break
+        finally:
+            closed.append(True)
+
+
+class _Write(object):
+    def __init__(self, fn, obj=None):
+        self.future = Future()
+        self.fn = fn
+        self.obj = obj
+        if obj is not None:
+            self.state = dict(obj.__dict__)
+            self.state['orm_dirty'] = dict(obj.orm_dirty)
+
+    def run(self):
+        return self.fn()
+
+    def undo(self):
+        if self.obj is not None:
+            self.obj.__dict__.clear()
+            self.obj.__dict__.update(self.state)
+            self.state['orm_dirty'] = dict(self.state['orm_dirty'])
+
+
+class WriteQueue(object):
+    def __init__(self, *args, **kwargs):
+        self.max_batch = kwargs.pop('max_batch', 100)
+        self.max_delay = kwargs.pop('max_delay', 0.005)
+        self.args = args
+        self.kwargs = kwargs
+        self.stats = dict(writes=0, batches=0, retries=0)
+        self._jobs = Queue.Queue()
+        self._thread = threading.Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _work(self):
+        if self.args or self.kwargs:
+            connection.connect(*self.args, **self.kwargs)
+        running = True
+        while running:
+            job = self._jobs.get()
+            if job is None:
+                break
+            batch = [job]
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    job = self._jobs.get(
+                        timeout=max(deadline - time.time(), 0))
+                except Queue.Empty:
+                    break
+                if job is None:
+                    running = False
+                    break
+                batch.append(job)
+            self._commit(batch)
+        connection.release()
+
+    def _commit(self, batch):
+        self.stats['batches'] += 1
+        self.stats['writes'] += len(batch)
+        try:
+            with connection.transaction():
+                results = [job.run() for job in batch]
+        except Exception:
+            for job in batch:
+                job.undo()
+        else:
+            for job, result in zip(batch, results):
+                job.future.set_result(result)
+            return
+        # retry one at a time, so that only the failing write's caller
+        # sees its error
+        self.stats['retries'] += 1
+        for job in batch:
+            try:
+                with connection.transaction():
+                    result = job.run()
+            except Exception:
+                job.undo()
+                job.future.set_exception(sys.exc_info())
+            else:
+                job.future.set_result(result)
+
+    def bypass(self):
+        # a write from the queue's own thread, or from a thread holding the
+        # writer or a transaction, would wait on itself; it runs in place,
+        # as part of whatever that thread is doing
+        return (threading.current_thread() is self._thread or
+                connection.writing())
+
+    def submit(self, fn, *args, **kwargs):
+        job = _Write(lambda: fn(*args, **kwargs))
+        self._jobs.put(job)
+        return job.future
+
+    def save(self, obj, reload=None):
+        job = _Write(lambda: obj._save(reload), obj)
+        self._jobs.put(job)
+        return job.future
+
+    def delete(self, obj):
+        job = _Write(obj._delete, obj)
+        self._jobs.put(job)
+        return job.future
+
+    def close(self, wait=True):
+        self._jobs.put(None)
+        if wait:
+            self._thread.join()
@@ -1,5 +1,10 @@
 import re
+import threading
+import weakref
+from itertools import islice
+from operator import itemgetter
 
+from . import connection
 from .query import *
 
 
@@ -9,6 +14,9 @@ all_ignore.add('all_ignore')
 
 REGISTERED_MODELS = {}
 
+write_stats = dict(unchanged=0, skipped_saves=0)
+_immutable = (basestring, int, long, float, type(None))
+
 
 def dereference_column(name):
     model_name, column_attr = name.split('.', 1)
@@ -26,8 +34,11 @@ class Column(Expr):
     primary = False
     adapter = None
     converter = None
+    deferred = False
+    db_default = False
 
-    def __init__(self, name=None, primary=None, adapter=None, converter=None):
+    def __init__(self, name=None, primary=None, adapter=None, converter=None,
+                 deferred=None, db_default=None):
         if name is not None:
             self.name = name
         self.attr = None
@@ -38,6 +49,10 @@ class Column(Expr):
             self.adapter = adapter
         if converter is not None:
             self.converter = converter
+        if deferred is not None:
+            self.deferred = deferred
+        if db_default is not None:
+            self.db_default = db_default
 
     def __copy__(self):
         column = self.__class__.__new__(self.__class__)
@@ -51,32 +66,183 @@ class Column(Expr):
             column.adapter = self.adapter
         if 'converter' in self.__dict__:
             column.converter = self.converter
+        if 'deferred' in self.__dict__:
+            column.deferred = self.deferred
+        if 'db_default' in self.__dict__:
+            column.db_default = self.db_default
         return column
 
     def __set__(self, obj, value):
-        obj.orm_dirty[self] = obj.__dict__.get(self.attr, Column.no_value)
+        dirty = obj.orm_dirty
+        original = dirty.get(self, Column.no_value)
+        if original is Column.no_value and self not in dirty:
+            original = obj.__dict__.get(self.attr, Column.no_value)
         obj.__dict__[self.attr] = value
+        if (self._unchanged(original, value) and
+                not getattr(obj, 'orm_new', True)):
+            dirty.pop(self, None)
+            write_stats['unchanged'] += 1
+            return
+        dirty[self] = original
+
+    def _unchanged(self, original, value):
+        if original is Column.no_value:
+            return False
+        if isinstance(original, Expr) or isinstance(value, Expr):
+            return False
+        # reassigning the same mutable object usually means it was changed
+        # in place, so it can't be compared against itself
+        if original is value:
+            return isinstance(value, _immutable)
+        if self.adapter is None:
+            return original == value
+        return self.adapter(original) == self.adapter(value)
 
     def set_from_db(self, obj, value):
         if self.converter is not None:
             value = self.converter(value)
         obj.__dict__[self.attr] = value
 
-    def sql(self):
+    def _compile(self, sql, args):
         if not self.name:
             raise TypeError('column must have a name')
         if self.model:
-            return '%s."%s"' % (self.model.alias_sql(), self.name)
-        return '"%s"' % (self.name,)
+            sql.append('%s."%s"' % (self.model.alias_sql(), self.name))
+        else:
+            sql.append('"%s"' % (self.name,))
 
-    def args(self):
-        return ()
+
+class _Deferred(object):
+    def __init__(self, column):
+        self.column = column
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self.column
+        try:
+            return obj.__dict__[self.column.attr]
+        except KeyError:
+            pass
+        obj._load_deferred(self.column)
+        return obj.__dict__.get(self.column.attr, self.column)
+
+    def __set__(self, obj, value):
+        self.column.__set__(obj, value)
+
+
+def _deferred_class(model, columns):
+    # instances missing some columns get a subclass whose descriptors load
+    # them on first access, so that fully loaded instances keep plain
+    # __dict__ attribute reads
+    classes = model.__dict__.get('orm_deferred_classes')
+    if classes is None:
+        model.orm_deferred_classes = classes = {}
+    key = tuple(column.attr for column in columns)
+    try:
+        return classes[key]
+    except KeyError:
+        pass
+    ns = dict((column.attr, _Deferred(column)) for column in columns)
+    ns['orm_model'] = model
+    ns['__module__'] = model.__module__
+    # type.__new__ skips the metaclass, which would register the class
+    classes[key] = cls = type.__new__(
+        type(model), '%s_deferred' % (model.__name__,), (model,), ns)
+    return cls
+
+
+_sessions = threading.local()
+
+
+def current_session():
+    stack = _sessions.__dict__.get('stack')
+    if stack:
+        return stack[-1]
+
+
+def _model(obj):
+    cls = obj.__class__
+    return cls.__dict__.get('orm_model', cls)
+
+
+class Session(object):
+    def __init__(self):
+        self.identity = weakref.WeakValueDictionary()
+
+    def _key(self, obj):
+        model = _model(obj)
+        try:
+            key = tuple(
+                obj.__dict__[column.attr]
+                for column in model.orm_primaries or (model.oid,)
+            )
+        except KeyError:
+            return None
+        if None not in key:
+            return (model, key)
+
+    def get(self, model, key):
+        return self.identity.get((model, key))
+
+    def add(self, obj):
+        key = self._key(obj)
+        if key is not None:
+            self.identity[key] = obj
+
+    def merge(self, obj):
+        key = self._key(obj)
+        if key is None:
+            return obj
+        return self.identity.setdefault(key, obj)
+
+    def discard(self, obj):
+        key = self._key(obj)
+        if key is not None and self.identity.get(key) is obj:
+            del self.identity[key]
+
+    def clear(self):
+        self.identity.clear()
+
+    def __len__(self):
+        return len(self.identity)
+
+    def __enter__(self):
+        _sessions.__dict__.setdefault('stack', []).append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _sessions.stack.pop()
+
+
+def _related(obj, relation, value):
+    related = obj.__dict__.get('orm_related')
+    if related is not None and relation in related:
+        loaded_value, other = related[relation]
+        if not isinstance(value, Expr) and loaded_value == value:
+            return True, other
+    return False, None
+
+
+def _relate(obj, relation, value, other):
+    related = obj.__dict__.get('orm_related')
+    if related is None:
+        obj.__dict__['orm_related'] = related = {}
+    related[relation] = (value, other)
+
+
+def _keys(objs, column):
+    return set(
+        value for value in (obj.__dict__.get(column.attr) for obj in objs)
+        if value is not None
+    )
 
 
 class ToOne(object):
     def __init__(self, my_column, other_column):
         self.my_column = my_column
         self.other_column = other_column
+        self.statement = None
+        self.alias = None
 
     def _dereference(self):
         if isinstance(self.other_column, basestring):
@@ -87,16 +253,58 @@ class ToOne(object):
             return self
         self._dereference()
         value = getattr(obj, self.my_column.attr)
-        q = self.other_column.model.find(self.other_column == value)
-        try:
-            return q[0]
-        except IndexError:
-            return None
+        loaded, other = _related(obj, self, value)
+        if loaded:
+            return other
+        if isinstance(value, Expr):
+            q = self.other_column.model.find(self.other_column == value)
+            try:
+                return q[0]
+            except IndexError:
+                return None
+        if value is None:
+            q = self.other_column.model.find(self.other_column == value)
+            try:
+                other = q[0]
+            except IndexError:
+                other = None
+            _relate(obj, self, value, other)
+            return other
+        session = current_session()
+        if session is not None:
+            model = self.other_column.model
+            keys = model.orm_primaries or (model.oid,)
+            if len(keys) == 1 and keys[0] is self.other_column:
+                other = session.get(model, (value,))
+                if other is not None:
+                    _relate(obj, self, value, other)
+                    return other
+        if self.statement is None:
+            q = self.other_column.model.find(
+                self.other_column == Param('value'))
+            q.limit = Limit(slice(0, 1))
+            self.statement = q.prepare()
+        other = self.statement.first(value=value)
+        _relate(obj, self, value, other)
+        return other
 
     def __set__(self, obj, other):
         self._dereference()
         value = getattr(other, self.other_column.attr)
         setattr(obj, self.my_column.attr, value)
+        _relate(obj, self, value, other)
+
+    def prefetch(self, objs):
+        self._dereference()
+        keys = _keys(objs, self.my_column)
+        others = {}
+        if keys:
+            q = self.other_column.model.find(self.other_column.isin(keys))
+            for other in q:
+                others[getattr(other, self.other_column.attr)] = other
+        for obj in objs:
+            value = obj.__dict__.get(self.my_column.attr)
+            _relate(obj, self, value, others.get(value))
 
 
 class ToMany(object):
@@ -113,11 +321,34 @@ class ToMany(object):
             return self
         self._dereference()
         value = getattr(obj, self.my_column.attr)
-        return self.other_column.model.find(self.other_column == value)
+        loaded, others = _related(obj, self, value)
+        if loaded:
+            return others
+        q = self._query(value)
+        if not isinstance(value, Expr):
+            _relate(obj, self, value, q)
+        return q
 
     def __set__(self, obj, value):
         raise AttributeError("can't set attribute")
 
+    def _query(self, value, rows=None):
+        return _related_select(
+            self.other_column.model.find(self.other_column == value), rows)
+
+    def prefetch(self, objs):
+        self._dereference()
+        keys = _keys(objs, self.my_column)
+        groups = {}
+        if keys:
+            q = self.other_column.model.find(self.other_column.isin(keys))
+            for other in q:
+                groups.setdefault(
+                    getattr(other, self.other_column.attr), []).append(other)
+        for obj in objs:
+            value = obj.__dict__.get(self.my_column.attr)
+            _relate(obj, self, value, self._query(value, groups.get(value, ())))
+
 
 class ManyToMany(object):
     def __init__(self, my_column, my_join, other_join, other_column):
@@ -139,15 +370,41 @@ class ManyToMany(object):
             return self
         self._dereference()
         value = getattr(obj, self.my_column.attr)
+        loaded, others = _related(obj, self, value)
+        if loaded:
+            return others
+        q = self._query(value)
+        if not isinstance(value, Expr):
+            _relate(obj, self, value, q)
+        return q
+
+    def __set__(self, obj, value):
+        raise AttributeError("can't set attribute")
+
+    def _query(self, value, rows=None):
         q = self.other_column.model.find(
             self.my_join == value,
             self.other_join == self.other_column
         )
         q.sources = ExprList([self.other_column.model, self.other_join.model])
-        return q
+        return _related_select(q, rows)
 
-    def __set__(self, obj, value):
-        raise AttributeError("can't set attribute")
+    def prefetch(self, objs):
+        self._dereference()
+        keys = _keys(objs, self.my_column)
+        groups = {}
+        if keys:
+            model = self.other_column.model
+            q = ModelSelect(
+                ExprList(list(model.orm_default_columns) + [self.my_join]),
+                ExprList([model, self.other_join.model]),
+                self.my_join.isin(keys) & (self.other_join == self.other_column))
+            for other, join in q:
+                groups.setdefault(
+                    getattr(join, self.my_join.attr), []).append(other)
+        for obj in objs:
+            value = obj.__dict__.get(self.my_column.attr)
+            _relate(obj, self, value, self._query(value, groups.get(value, ())))
 
 
 class Model(object):
@@ -156,8 +413,11 @@ class Model(object):
 
     orm_new = True
     orm_columns = ExprList([oid])
+    orm_default_columns = orm_columns
     orm_primaries = ()
     orm_alias = None
+    orm_write_queue = None
+    orm_reload = 'all'
 
     class __metaclass__(type):
         def __init__(cls, name, bases, ns):
@@ -186,6 +446,10 @@ class Model(object):
                         value.model = cls
                     if value.primary:
                         primaries.append(value)
+            cls.orm_default_columns = columns
+            if any(column.deferred for column in columns):
+                cls.orm_default_columns = ExprList(
+                    column for column in columns if not column.deferred)
             REGISTERED_MODELS[name] = cls
 
     def __new__(cls, *args, **kwargs):
@@ -200,9 +464,58 @@ class Model(object):
             for column in self.orm_primaries or (self.__class__.oid,)
         ))
 
-    def save(self):
+    @classmethod
+    def _prepared(cls, name, build):
+        statements = cls.__dict__.get('orm_statements')
+        if statements is None:
+            cls.orm_statements = statements = {}
+        try:
+            return statements[name]
+        except KeyError:
+            statements[name] = statement = build().prepare()
+            return statement
+
+    @classmethod
+    def _select_by(cls, columns, what=None):
+        if what is None:
+            what = cls.orm_columns
+        q = ModelSelect(what, cls, reduce(And, (
+            column == Param(column.attr) for column in columns
+        )))
+        q.limit = Limit(slice(0, 1))
+        return q
+
+    @classmethod
+    def get(cls, *keys):
+        columns = cls.orm_primaries or (cls.oid,)
+        if len(keys) != len(columns):
+            raise TypeError('expected %d key values, got %d' % (
+                len(columns), len(keys)))
+        session = current_session()
+        if session is not None:
+            obj = session.get(cls, keys)
+            if obj is not None:
+                return obj
+        statement = cls._prepared('get', lambda: cls._select_by(
+            columns, cls.orm_default_columns))
+        return statement.first(**dict(
+            (column.attr, key) for column, key in zip(columns, keys)))
+
+    def save(self, reload=None):
+        queue = self.orm_write_queue
+        if queue is not None and (self.orm_new or self.orm_dirty) and (
+                not queue.bypass()):
+            return queue.save(self, reload).result()
+        return self._save(reload)
+
+    def _save(self, reload=None):
         if not (self.orm_new or self.orm_dirty):
+            write_stats['skipped_saves'] += 1
             return
+        if reload is None:
+            reload = self.orm_reload
+        if reload not in _reload_modes:
+            raise ValueError('unknown reload mode %r' % (reload,))
         columns = ExprList()
         attrs = ExprList()
         for column in self.orm_columns:
@@ -213,24 +526,240 @@ class Model(object):
             if column.adapter is not None:
                 value = column.adapter(value)
             attrs.append(value)
+        cls = self.__class__
+        if reload == 'returning' and not _has_returning():
+            reload = 'all'
         if self.orm_new:
             q = Insert(self, columns or None, attrs or None)
+            if reload == 'returning':
+                q.returning = ExprList(
+                    Sql('"%s"' % (column.name,)) for column in cls.orm_columns)
         else:
             q = Update(self, columns, attrs, self._where())
-        cur = q.execute()
+        row = None
+        if self.orm_new and reload == 'returning':
+            # the returned row has to be read before the write commits,
+            # which sqlite refuses while the statement is still running
+            with connection.borrow() as con:
+                cur = con.cursor()
+                cur.execute(*q.compile())
+                row = cur.fetchone()
+        else:
+            cur = q.execute()
         if self.orm_new:
             self.orm_new = False
-            cls = self.__class__
-            row = Select(cls.orm_columns, cls, cls.oid == cur.lastrowid)[0]
-            for column, value in zip(cls.orm_columns, row):
-                column.set_from_db(self, value)
+            if reload == 'all':
+                statement = cls._prepared(
+                    'get_oid', lambda: cls._select_by((cls.oid,)))
+                row = statement.execute(oid=cur.lastrowid).fetchone()
+            elif reload != 'returning':
+                self._reload_keys(cur.lastrowid, reload == 'defaults')
+            if row is not None:
+                for column, value in zip(cls.orm_columns, row):
+                    column.set_from_db(self, value)
+            session = current_session()
+            if session is not None:
+                session.add(self)
         self.orm_dirty.clear()
 
+    def _reload_keys(self, rowid, defaults):
+        cls = self.__class__
+        keys = cls._generated_keys(self.orm_dirty)
+        for key in keys:
+            key.set_from_db(self, rowid)
+        # primary keys the database filled in some other way, and with
+        # defaults, columns with database defaults, are read back by rowid
+        columns = [
+            column for column in cls.orm_columns
+            if column not in self.orm_dirty and
+            not any(column is key for key in keys) and (
+                any(column is key for key in cls.orm_primaries) or
+                defaults and column.db_default)
+        ]
+        if not columns:
+            return
+        statement = cls._prepared(
+            'reload_' + ','.join(column.attr for column in columns),
+            lambda: Select(ExprList(columns), cls, cls.oid == Param('oid')))
+        row = statement.execute(oid=rowid).fetchone()
+        if row is not None:
+            for column, value in zip(columns, row):
+                column.set_from_db(self, value)
+
+    def _find_keys(self, conflict, values):
+        # an upsert that updated an existing row leaves lastrowid alone, so
+        # the row is looked up again by the columns it conflicted on
+        cls = self.__class__
+        keys = [cls.oid] + [key for key in cls.orm_primaries
+                            if key not in self.orm_dirty]
+        statement = cls._prepared(
+            'upsert_%s_%s' % (
+                ','.join(column.attr for column in keys),
+                ','.join(column.attr for column in conflict)),
+            lambda: Select(ExprList(keys), cls, reduce(And, (
+                column == Param(column.attr) for column in conflict))))
+        row = statement.execute(**values).fetchone()
+        if row is not None:
+            for column, value in zip(keys, row):
+                column.set_from_db(self, value)
+
+    @classmethod
+    def _generated_keys(cls, columns):
+        # the rowid, and a lone primary key the insert left to the database
+        # when sqlite made it an alias of the rowid
+        keys = [cls.oid]
+        if len(cls.orm_primaries) == 1 and not any(
+                column is cls.orm_primaries[0] for column in columns) and (
+                cls._rowid_alias()):
+            keys.append(cls.orm_primaries[0])
+        return keys
+
+    @classmethod
+    def _rowid_alias(cls):
+        # only a column declared "integer primary key" aliases the rowid,
+        # so the table is asked once
+        alias = cls.__dict__.get('orm_rowid_alias')
+        if alias is None:
+            cur = connection.execute(
+                'pragma table_info("%s")' % (cls.orm_table,), readonly=True)
+            primaries = [row for row in cur if row[5]]
+            cls.orm_rowid_alias = alias = (
+                len(primaries) == 1 and
+                primaries[0][1] == cls.orm_primaries[0].name and
+                primaries[0][2].lower() == 'integer')
+        return alias
+
+    @classmethod
+    def insert_many(cls, rows, chunk=1000, assign_keys=False):
+        rows = iter(rows)
+        count = 0
+        with connection.transaction():
+            while True:
+                batch = list(islice(rows, chunk))
+                if not batch:
+                    break
+                for columns, objs, values in cls._insert_groups(batch):
+                    cls._insert_group(columns, objs, values, assign_keys)
+                count += len(batch)
+        return count
+
+    @classmethod
+    def upsert_many(cls, rows, conflict=None, update=None, chunk=1000):
+        if conflict is None:
+            conflict = cls.orm_primaries
+        if not conflict:
+            raise TypeError('must specify conflict columns')
+        if not _has_upsert():
+            raise RuntimeError('upsert_many needs sqlite 3.24 or later')
+        target = [column.name for column in conflict]
+        rows = iter(rows)
+        count = 0
+        with connection.transaction():
+            while True:
+                batch = list(islice(rows, chunk))
+                if not batch:
+                    break
+                for columns, objs, values in cls._insert_groups(batch):
+                    # only columns this group inserts can come from excluded
+                    names = [column.name for column in columns]
+                    if update is None:
+                        updated = [name for name in names
+                                   if name not in target]
+                    else:
+                        updated = [column.name for column in update
+                                   if column.name in names]
+                    cls._insert_group(columns, objs, values, False,
+                                      OnConflict(target, updated), conflict)
+                count += len(batch)
+        return count
+
+    @classmethod
+    def _insert_groups(cls, batch):
+        # rows setting the same columns share one statement
+        by_attr = dict((column.attr, column) for column in cls.orm_columns)
+        groups = {}
+        order = []
+        for row in batch:
+            if isinstance(row, dict):
+                for attr in row:
+                    if attr not in by_attr:
+                        raise TypeError('unknown column %r' % (attr,))
+                obj = None
+                columns = [column for column in cls.orm_columns
+                           if column.attr in row]
+                values = [row[column.attr] for column in columns]
+            else:
+                obj = row
+                columns = [column for column in cls.orm_columns
+                           if column in obj.orm_dirty]
+                values = [getattr(obj, column.attr) for column in columns]
+            for i, column in enumerate(columns):
+                if column.adapter is not None:
+                    values[i] = column.adapter(values[i])
+            key = tuple(column.attr for column in columns)
+            group = groups.get(key)
+            if group is None:
+                groups[key] = group = (columns, [], [])
+                order.append(key)
+            group[1].append(obj)
+            group[2].append(tuple(values))
+        return [groups[key] for key in order]
+
+    @classmethod
+    def _insert_group(cls, columns, objs, values, assign_keys,
+                      on_conflict=None, conflict=()):
+        if columns:
+            q = Insert(
+                cls,
+                ExprList(Sql('"%s"' % (column.name,)) for column in columns),
+                ExprList(Param(column.attr) for column in columns),
+                on_conflict,
+            )
+        else:
+            q = Insert(cls, on_conflict=on_conflict)
+        sql = q.sql()
+        # instances are marked saved, so unless the rows carry the keys
+        # that save() and delete() look them up by, those are assigned too
+        keys = assign_keys or (
+            any(obj is not None for obj in objs) and
+            not all(any(key is column for column in columns)
+                    for key in cls.orm_primaries or (cls.oid,)))
+        with connection.borrow() as con:
+            cur = con.cursor()
+            if not keys:
+                cur.executemany(sql, values)
+            else:
+                for obj, row in zip(objs, values):
+                    cur.execute(sql, row)
+                    if obj is None:
+                        continue
+                    if conflict:
+                        obj._find_keys(conflict, dict(zip(
+                            (column.attr for column in columns), row)))
+                    else:
+                        obj._reload_keys(cur.lastrowid, False)
+        session = current_session()
+        for obj in objs:
+            if obj is not None:
+                obj.orm_new = False
+                obj.orm_dirty.clear()
+                if session is not None and keys:
+                    session.add(obj)
+
     def delete(self):
+        queue = self.orm_write_queue
+        if queue is not None and not queue.bypass():
+            return queue.delete(self).result()
+        return self._delete()
+
+    def _delete(self):
         if self.orm_new:
             return
         q = Delete(self, self._where())
         q.execute()
+        session = current_session()
+        if session is not None:
+            session.discard(self)
         self.orm_new = True
         self.orm_dirty = dict(
             (column, self.__dict__[column.attr])
@@ -242,18 +771,84 @@ class Model(object):
         if self.orm_new:
             return
         cls = self.__class__
-        row = Select(cls.orm_columns, cls, self._where())[0]
+        columns = cls.orm_primaries or (cls.oid,)
+        statement = cls._prepared('reload', lambda: cls._select_by(columns))
+        row = statement.execute(**dict(
+            (column.attr, self.orm_dirty.get(
+                column, getattr(self, column.attr)))
+            for column in columns
+        )).fetchone()
+        if row is None:
+            raise IndexError(0)
         for column, value in zip(cls.orm_columns, row):
             column.set_from_db(self, value)
         self.orm_dirty.clear()
+        self.expire()
+
+    def expire(self, *relations):
+        related = self.__dict__.get('orm_related')
+        if related is None:
+            return
+        if not relations:
+            del self.__dict__['orm_related']
+        for relation in relations:
+            related.pop(relation, None)
+
+    def _load_deferred(self, column):
+        model = self.__class__.orm_model
+        keys = model.orm_primaries or (model.oid,)
+        batch = self.__dict__.get('orm_batch')
+        if batch is not None and len(keys) == 1:
+            key = keys[0]
+            objs = {}
+            for obj in batch:
+                if column.attr not in obj.__dict__ and isinstance(obj, model):
+                    objs[obj.orm_dirty.get(key, getattr(obj, key.attr))] = obj
+            q = Select(ExprList([key, column]), model, key.isin(objs))
+            for value, row_value in q:
+                if key.converter is not None:
+                    value = key.converter(value)
+                obj = objs.get(value)
+                if obj is not None:
+                    column.set_from_db(obj, row_value)
+            return
+        statement = model._prepared('load_' + column.attr, lambda: Select(
+            ExprList([column]), model, reduce(And, (
+                key == Param(key.attr) for key in keys
+            )), limit=Limit(slice(0, 1))))
+        row = statement.execute(**dict(
+            (key.attr, self.orm_dirty.get(key, getattr(self, key.attr)))
+            for key in keys
+        )).fetchone()
+        if row is not None:
+            column.set_from_db(self, row[0])
 
     @classmethod
     def find(cls, *where):
-        q = ModelSelect(cls.orm_columns, cls)
+        q = ModelSelect(cls.orm_default_columns, cls)
         if where:
             q = q.find(*where)
         return q
 
+    @classmethod
+    def scan(cls, chunk=10000, where=None):
+        # walk the table in key order with a fresh bounded query per chunk,
+        # so that no statement or read transaction outlives its chunk
+        by = tuple(cls.orm_primaries or (cls.oid,))
+        q = cls.find() if where is None else cls.find(where)
+        key = None
+        while True:
+            if key is None:
+                page = q.order_by(*by)[:chunk]
+            else:
+                page = q.after(by, key)[:chunk]
+            rows = list(iter(page))
+            for obj in rows:
+                yield obj
+            if len(rows) < chunk:
+                break
+            key = q._key(rows[-1], by)
+
     @classmethod
     def as_alias(cls, alias):
         return type(
@@ -278,19 +873,372 @@ class Model(object):
     def args(cls):
         return ()
 
+    @classmethod
+    def _compile(cls, sql, args):
+        sql.append(cls.sql())
+
 
 class ModelSelect(Select):
+    batch_load = False
+    joins = ()
+    prefetches = ()
+
+    def prefetch(self, *relations):
+        return self._copy(prefetches=self.prefetches + relations)
+
+    def update(self, **assignments):
+        if isinstance(self.sources, (ExprList, LeftJoin)):
+            raise TypeError("can't update more than one table")
+        if self.limit is not None:
+            raise TypeError("can't update a sliced query")
+        model = self.sources
+        for attr in assignments:
+            if not isinstance(getattr(model, attr, None), Column):
+                raise TypeError('unknown column %r' % (attr,))
+        columns = ExprList()
+        values = ExprList()
+        for column in model.orm_columns:
+            if column.attr not in assignments:
+                continue
+            value = assignments[column.attr]
+            if column.adapter is not None and not isinstance(value, Expr):
+                value = column.adapter(value)
+            columns.append(Sql('"%s"' % (column.name,)))
+            values.append(value)
+        if not columns:
+            return 0
+        return Update(model, columns, values, self.where).execute().rowcount
+
+    def _results(self, cur):
+        if not self.prefetches or self.batch_size is not None:
+            return super(ModelSelect, self)._results(cur)
+        rows = list(super(ModelSelect, self)._results(cur))
+        self._prefetch(rows)
+        return iter(rows)
+
+    def _batches(self, cur, size):
+        for rows in super(ModelSelect, self)._batches(cur, size):
+            if self.prefetches:
+                self._prefetch(rows)
+            yield rows
+
+    def _prefetch(self, rows):
+        for relation in self.prefetches:
+            model = relation.my_column.model
+            objs = []
+            for row in rows:
+                for obj in row if isinstance(row, tuple) else (row,):
+                    if isinstance(obj, model):
+                        objs.append(obj)
+                        break
+            relation.prefetch(objs)
+
+    def defer(self, *columns, **kwargs):
+        deferred = set(map(id, columns))
+        return self._project(
+            [column for column in self.what if id(column) not in deferred],
+            kwargs)
+
+    def only(self, *columns, **kwargs):
+        keep = set(map(id, columns))
+        what = []
+        for model in self._models():
+            keep.update(map(id, model.orm_primaries or (model.oid,)))
+            what.extend(
+                column for column in model.orm_columns if id(column) in keep)
+        return self._project(what, kwargs)
+
+    def _project(self, what, kwargs):
+        batch_load = kwargs.pop('batch', self.batch_load)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments %r' % (kwargs,))
+        return self._copy(what=ExprList(what), batch_load=batch_load)
+
+    def join_load(self, *relations):
+        q = self
+        for relation in relations:
+            q = q._join_load(relation)
+        return q
+
+    def _join_load(self, relation):
+        relation._dereference()
+        for model in self._models():
+            if issubclass(model, relation.my_column.model):
+                break
+        else:
+            raise TypeError('relation does not belong to this query')
+        my_column = getattr(model, relation.my_column.attr)
+        other = relation.other_column.model
+        tables = set(source.orm_table for source in self._models())
+        if other.orm_table in tables:
+            if relation.alias is None:
+                relation.alias = other.as_alias('%s_%s' % (
+                    other.orm_table, relation.my_column.attr))
+            other = relation.alias
+        on = getattr(other, relation.other_column.attr) == my_column
+        return self._copy(
+            what=ExprList(list(self.what) + list(other.orm_default_columns)),
+            sources=LeftJoin(self.sources, other, on),
+            joins=self.joins + ((relation, model, other),),
+        )
+
+    def _models(self):
+        models = []
+        for column in self.what:
+            if column.model not in models:
+                models.append(column.model)
+        return models
+
+    def _key(self, row, columns):
+        key = []
+        for column in columns:
+            obj = row
+            if isinstance(row, tuple):
+                for obj in row:
+                    if _model(obj) is column.model:
+                        break
+            value = getattr(obj, column.attr)
+            if column.adapter is not None:
+                value = column.adapter(value)
+            key.append(value)
+        return key
+
+    def values(self, *columns):
+        return TupleSelect(ExprList(columns or self.what), self.sources,
+                           self.where, self.order, self.limit, self.batch_size)
+
+    def tuples(self):
+        return self.values()
+
+    def dicts(self, *columns):
+        return DictSelect(ExprList(columns or self.what), self.sources,
+                          self.where, self.order, self.limit, self.batch_size)
+
+    def scalars(self, column):
+        return ScalarSelect(column, self.sources, self.where, self.order,
+                            self.limit, self.batch_size)
+
+    def _hydrator(self):
+        columns = tuple(self.what)
+        model = columns[0].model
+        hydrators = model.__dict__.get('orm_hydrators')
+        if hydrators is None:
+            model.orm_hydrators = hydrators = {}
+        key = tuple(map(id, columns))
+        try:
+            hydrate = hydrators[key][1]
+        except KeyError:
+            # keep the columns alive along with the entry, so their ids
+            # cannot be reused by other columns
+            hydrate = _build_hydrator(columns)
+            hydrators[key] = (columns, hydrate)
+        session = current_session()
+        if session is not None:
+            hydrate = _merging(hydrate, session)
+        if self.joins:
+            hydrate = _attaching(hydrate, self._models(), self.joins)
+        if not self.batch_load:
+            return hydrate
+        # everything hydrated together loads its deferred columns together
+        batch = []
+
+        def hydrate_batch(row):
+            res = hydrate(row)
+            for obj in res if isinstance(res, tuple) else (res,):
+                obj.__dict__['orm_batch'] = batch
+                batch.append(obj)
+            return res
+        return hydrate_batch
+
+
+class RelatedSelect(ModelSelect):
+    # a relationship's query, which keeps its rows once they are loaded;
+    # refining it gives back a plain ModelSelect
+    results = None
+
+    def _loaded(self):
+        if self.results is None:
+            self.results = ResultSet(self).fill()
+        return self.results
+
     def __iter__(self):
-        for row in super(ModelSelect, self).__iter__():
-            res = []
-            indexes = {}
-            for column, value in zip(self.what, row):
-                if column.model not in indexes:
-                    indexes[column.model] = len(res)
-                    res.append(column.model.__new__(column.model))
-                    res[-1].orm_new = False
-                column.set_from_db(res[indexes[column.model]], value)
-            yield res[0] if len(res) == 1 else tuple(res)
+        return iter(self._loaded())
+
+    def __len__(self):
+        return len(self._loaded())
+
+    def __getitem__(self, y):
+        if isinstance(y, (int, long)):
+            return self._loaded()[y]
+        return super(RelatedSelect, self).__getitem__(y)
+
+    def _copy(self, **changes):
+        q = ModelSelect.__new__(ModelSelect)
+        q.__dict__.update(self.__dict__)
+        q.__dict__.pop('results', None)
+        q.__dict__.update(changes)
+        return q
+
+
+def _related_select(q, rows=None):
+    related = RelatedSelect.__new__(RelatedSelect)
+    related.__dict__.update(q.__dict__)
+    if rows is not None:
+        related.results = ResultSet(related, rows)
+    return related
+
+
+_reload_modes = ('all', 'none', 'defaults', 'returning')
+
+
+def _has_returning():
+    version = getattr(connection.sqlite3, 'sqlite_version_info', ())
+    return version >= (3, 35, 0)
+
+
+def _has_upsert():
+    version = getattr(connection.sqlite3, 'sqlite_version_info', ())
+    return version >= (3, 24, 0)
+
+
+def _merging(hydrate, session):
+    # hand back instances already in the session's identity map
+    def merge(row):
+        res = hydrate(row)
+        if isinstance(res, tuple):
+            return tuple(map(session.merge, res))
+        return session.merge(res)
+    return merge
+
+
+def _attaching(hydrate, models, joins):
+    # move join loaded instances from the result row into their owners
+    attach = []
+    for relation, model, other in joins:
+        keys = other.orm_primaries or (other.oid,)
+        attach.append((relation, models.index(model), models.index(other),
+                       relation.my_column.attr, keys[0].attr))
+    joined = set(index for _, _, index, _, _ in attach)
+    keep = [i for i in xrange(len(models)) if i not in joined]
+
+    def attach_related(row):
+        res = hydrate(row)
+        for relation, owner, index, attr, key in attach:
+            other = res[index]
+            if other.__dict__.get(key) is None:
+                other = None
+            obj = res[owner]
+            _relate(obj, relation, obj.__dict__.get(attr), other)
+        if len(keep) == 1:
+            return res[keep[0]]
+        return tuple(res[i] for i in keep)
+    return attach_related
+
+
+def _converters(columns):
+    return [
+        (i, column.converter) for i, column in enumerate(columns)
+        if getattr(column, 'converter', None) is not None
+    ]
+
+
+class TupleSelect(Select):
+    def _hydrator(self):
+        converters = _converters(self.what)
+        if not converters:
+            return tuple
+
+        def hydrate(row):
+            row = list(row)
+            for i, converter in converters:
+                row[i] = converter(row[i])
+            return tuple(row)
+        return hydrate
+
+
+class DictSelect(Select):
+    def _hydrator(self):
+        keys = [getattr(column, 'attr', None) or column.sql()
+                for column in self.what]
+        converters = _converters(self.what)
+
+        def hydrate(row):
+            res = dict(zip(keys, row))
+            for i, converter in converters:
+                res[keys[i]] = converter(row[i])
+            return res
+        return hydrate
+
+
+class ScalarSelect(Select):
+    def _hydrator(self):
+        converter = getattr(self.what, 'converter', None)
+        if converter is None:
+            return itemgetter(0)
+        return lambda row: converter(row[0])
+
+
+def _build_hydrator(columns):
+    # generate a function specialised to this column layout, which unpacks
+    # the row and fills each instance's __dict__ in one go
+    env = dict(columns=columns, hydrate_any=_hydrate_any)
+    models = []
+    items = {}
+    calls = []
+    values = []
+    for i, column in enumerate(columns):
+        value = 'v%d' % (i,)
+        values.append(value)
+        if column.model not in models:
+            models.append(column.model)
+            env['m%d' % (len(models) - 1,)] = column.model
+            items[column.model] = ["'orm_new': False"]
+        obj = 'o%d' % (models.index(column.model),)
+        if type(column).set_from_db.im_func is not _set_from_db:
+            env['s%d' % (i,)] = column.set_from_db
+            calls.append('    s%d(%s, %s)' % (i, obj, value))
+            continue
+        if column.converter is not None:
+            env['c%d' % (i,)] = column.converter
+            value = 'c%d(%s)' % (i, value)
+        items[column.model].append('%r: %s' % (column.attr, value))
+    lines = ['def hydrate(row):']
+    lines.append('    try:')
+    lines.append('        %s, = row' % (', '.join(values),))
+    lines.append('    except ValueError:')
+    lines.append('        return hydrate_any(columns, row)')
+    for i, model in enumerate(models):
+        lines.append('    o%d = m%d.__new__(m%d)' % (i, i, i))
+        lines.append('    o%d.__dict__.update({%s})' % (
+            i, ', '.join(items[model])))
+    for i, model in enumerate(models):
+        present = set(id(column) for column in columns
+                      if column.model is model)
+        missing = [column for column in model.orm_columns
+                   if id(column) not in present]
+        keys = model.orm_primaries or (model.oid,)
+        if missing and all(id(key) in present for key in keys):
+            env['m%d' % (i,)] = _deferred_class(model, missing)
+    lines.extend(calls)
+    lines.append('    return %s' % (', '.join(
+        'o%d' % (i,) for i in xrange(len(models))),))
+    exec '\n'.join(lines) in env
+    return env['hydrate']
+
+
+def _hydrate_any(columns, row):
+    res = []
+    indexes = {}
+    for column, value in zip(columns, row):
+        if column.model not in indexes:
+            indexes[column.model] = len(res)
+            res.append(column.model.__new__(column.model))
+            res[-1].orm_new = False
+        column.set_from_db(res[indexes[column.model]], value)
+    return res[0] if len(res) == 1 else tuple(res)
+
+
+_set_from_db = Column.set_from_db.im_func
 
 
 __all__ = list(set(locals()) - all_ignore)
@@ -1,3 +1,7 @@
+import base64
+import json
+from itertools import chain, imap
+
 from . import connection
 
 
@@ -8,20 +12,22 @@ binary_ops = [
     ('Gt', '>', '__gt__'),
     ('Le', '<=', '__le__'),
     ('Ge', '>=', '__ge__'),
-    ('And', 'and', '__and__'),
-    ('Or', 'or', '__or__'),
     ('Add', '+', '__add__'),
     ('Sub', '-', '__sub__'),
     ('Mul', '*', '__mul__'),
     ('Div', '/', '__div__'),
     ('Mod', '%', '__mod__'),
-    ('In', 'in', 'isin'),
     ('Like', 'like', 'like'),
     ('Glob', 'glob', 'glob'),
     ('Match', 'match', 'match'),
     ('Regexp', 'regexp', 'regexp'),
 ]
 
+nary_ops = [
+    ('And', 'and', '__and__'),
+    ('Or', 'or', '__or__'),
+]
+
 prefix_unary_ops = [
     ('Not', 'not', '__invert__'),
     ('Pos', '+', '__pos__'),
@@ -35,6 +41,8 @@ postfix_unary_ops = [
 
 
 class Expr(object):
+    readonly = False
+
     def __init__(self, value):
         self.value = value
 
@@ -45,7 +53,7 @@ class Expr(object):
         ''' % (method_name, class_name)).strip()
     del class_name, op, method_name
 
-    for class_name, op, method_name in binary_ops[2:]:
+    for class_name, op, method_name in binary_ops[2:] + nary_ops:
         exec ('''
             def %s(self, other):
                 return %s(self, other)
@@ -62,49 +70,91 @@ class Expr(object):
             return NotNull(self)
         return Ne(self, other)
 
-    def sql(self):
+    def isin(self, other):
+        return In(self, other)
+
+    def _compile(self, sql, args):
         try:
-            sql = self.value.sql
+            compile = self.value._compile
         except AttributeError:
-            return '?'
-        return sql()
+            if hasattr(self.value, 'sql'):
+                sql.append(self.value.sql())
+                args.extend(self.value.args())
+            else:
+                sql.append('?')
+                args.append(self.value)
+            return
+        compile(sql, args)
+
+    def compile(self):
+        sql = []
+        args = []
+        self._compile(sql, args)
+        return ''.join(sql), tuple(args)
+
+    def sql(self):
+        return self.compile()[0]
 
     def args(self):
-        try:
-            args = self.value.args
-        except AttributeError:
-            return (self.value,)
-        return args()
+        return self.compile()[1]
 
     def execute(self):
-        cur = connection.get_connection().cursor()
-        cur.execute(self.sql(), self.args())
-        return cur
+        sql, args = self.compile()
+        return connection.execute(sql, args, self.readonly)
 
     def executemany(self, args):
-        cur = connection.get_connection().cursor()
-        cur.executemany(self.sql(), args)
+        return connection.executemany(self.sql(), args, self.readonly)
+
+    def prepare(self):
+        return Prepared(self)
+
+    def _results(self, cur):
         return cur
 
 
+def _compile(obj, sql, args):
+    try:
+        compile = obj._compile
+    except AttributeError:
+        sql.append(obj.sql())
+        args.extend(obj.args())
+        return
+    compile(sql, args)
+
+
+def _compile_operand(obj, sql, args):
+    if isinstance(obj, Parenthesizing):
+        sql.append('(')
+        obj._compile(sql, args)
+        sql.append(')')
+    else:
+        obj._compile(sql, args)
+
+
 class Parenthesizing(object):
     pass
 
 
 class PrefixUnaryOp(Expr, Parenthesizing):
-    def sql(self):
-        sql = super(PrefixUnaryOp, self).sql()
+    def _compile(self, sql, args):
         if isinstance(self.value, Parenthesizing):
-            return '%s (%s)' % (self._op, sql)
-        return '%s %s' % (self._op, sql)
+            sql.append(self._op + ' (')
+            super(PrefixUnaryOp, self)._compile(sql, args)
+            sql.append(')')
+        else:
+            sql.append(self._op + ' ')
+            super(PrefixUnaryOp, self)._compile(sql, args)
 
 
 class PostfixUnaryOp(Expr, Parenthesizing):
-    def sql(self):
-        sql = super(PostfixUnaryOp, self).sql()
+    def _compile(self, sql, args):
         if isinstance(self.value, Parenthesizing):
-            return '(%s) %s' % (sql, self._op)
-        return '%s %s' % (sql, self._op)
+            sql.append('(')
+            super(PostfixUnaryOp, self)._compile(sql, args)
+            sql.append(') ' + self._op)
+        else:
+            super(PostfixUnaryOp, self)._compile(sql, args)
+            sql.append(' ' + self._op)
 
 
 for class_name, op, method_name in prefix_unary_ops:
@@ -122,17 +172,10 @@ class BinaryOp(Expr, Parenthesizing):
         self.lvalue = lvalue if isinstance(lvalue, Expr) else Expr(lvalue)
         self.rvalue = rvalue if isinstance(rvalue, Expr) else Expr(rvalue)
 
-    def sql(self):
-        lsql = self.lvalue.sql()
-        if isinstance(self.lvalue, Parenthesizing):
-            lsql = '(%s)' % (lsql,)
-        rsql = self.rvalue.sql()
-        if isinstance(self.rvalue, Parenthesizing):
-            rsql = '(%s)' % (rsql,)
-        return '%s %s %s' % (lsql, self._op, rsql)
-
-    def args(self):
-        return self.lvalue.args() + self.rvalue.args()
+    def _compile(self, sql, args):
+        _compile_operand(self.lvalue, sql, args)
+        sql.append(' %s ' % (self._op,))
+        _compile_operand(self.rvalue, sql, args)
 
 
 for class_name, op, method_name in binary_ops:
@@ -140,7 +183,113 @@ for class_name, op, method_name in binary_ops:
 del class_name, op, method_name, binary_ops
 
 
+class NaryOp(BinaryOp):
+    def __init__(self, *values):
+        if len(values) < 2:
+            raise TypeError('need at least two operands')
+        self.values = []
+        for value in values:
+            # merge nested uses of the same operator into one flat node
+            if type(value) is type(self):
+                self.values.extend(value.values)
+            else:
+                self.values.append(
+                    value if isinstance(value, Expr) else Expr(value))
+
+    @property
+    def lvalue(self):
+        return self.values[0]
+
+    @property
+    def rvalue(self):
+        if len(self.values) == 2:
+            return self.values[1]
+        return type(self)(*self.values[1:])
+
+    def _compile(self, sql, args):
+        separator = None
+        for value in self.values:
+            if separator is None:
+                separator = ' %s ' % (self._op,)
+            else:
+                sql.append(separator)
+            _compile_operand(value, sql, args)
+
+
+for class_name, op, method_name in nary_ops:
+    locals()[class_name] = type(class_name, (NaryOp,), dict(_op=op))
+del class_name, op, method_name, nary_ops
+
+
+class In(BinaryOp):
+    _op = 'in'
+
+    def __init__(self, lvalue, rvalue):
+        if not (
+            isinstance(rvalue, (Expr, basestring)) or
+            hasattr(rvalue, 'sql') or
+            not hasattr(rvalue, '__iter__')
+        ):
+            rvalue = InList(rvalue)
+        super(In, self).__init__(lvalue, rvalue)
+
+
+_json_types = (int, long, float, basestring, bool, type(None))
+
+
+class InList(Expr, Parenthesizing):
+    strategy = 'auto'
+    # the largest bucket that stays under older SQLite builds' default
+    # limit of 999 variables per statement
+    json_threshold = 512
+
+    def __init__(self, values, strategy=None):
+        self.values = tuple(values)
+        if strategy is not None:
+            self.strategy = strategy
+
+    def _plan(self):
+        values = self.values
+        strategy = self.strategy
+        if strategy == 'auto':
+            strategy = 'bucket'
+            if len(values) > self.json_threshold:
+                for value in values:
+                    if not isinstance(value, _json_types):
+                        break
+                else:
+                    strategy = 'json'
+        if strategy == 'json':
+            try:
+                return strategy, (json.dumps(values),)
+            except UnicodeDecodeError:
+                if self.strategy == 'json':
+                    raise
+                strategy = 'bucket'
+        if strategy == 'bucket' and values:
+            # pad to a power of two so that lists of similar length share
+            # one statement
+            size = 1
+            while size < len(values):
+                size *= 2
+            return strategy, values + values[-1:] * (size - len(values))
+        if strategy not in ('bucket', 'expand'):
+            raise ValueError('unknown strategy %r' % (strategy,))
+        return 'expand', values
+
+    def _compile(self, sql, args):
+        strategy, params = self._plan()
+        if strategy == 'json':
+            sql.append('select value from json_each(?)')
+        else:
+            sql.append(', '.join(['?'] * len(params)))
+        args.extend(params)
+
+
 class Sql(Expr):
+    def _compile(self, sql, args):
+        sql.append(self.value)
+
     def sql(self):
         return self.value
 
@@ -148,6 +297,47 @@ class Sql(Expr):
         return ()
 
 
+class Param(Expr):
+    def _compile(self, sql, args):
+        sql.append('?')
+        args.append(self)
+
+
+class Prepared(object):
+    def __init__(self, query):
+        self.query = query
+        self.sql, args = query.compile()
+        self.args = list(args)
+        self.params = [
+            (i, arg.value) for i, arg in enumerate(args)
+            if isinstance(arg, Param)
+        ]
+
+    def bind(self, bindings):
+        args = self.args[:]
+        for i, name in self.params:
+            try:
+                args[i] = bindings[name]
+            except KeyError:
+                raise TypeError('no value for parameter %r' % (name,))
+        return tuple(args)
+
+    def execute(self, **bindings):
+        return connection.execute(
+            self.sql, self.bind(bindings), self.query.readonly)
+
+    def many(self, bindings):
+        return connection.executemany(
+            self.sql, (self.bind(b) for b in bindings), self.query.readonly)
+
+    def __call__(self, **bindings):
+        return self.query._results(self.execute(**bindings))
+
+    def first(self, **bindings):
+        for row in self(**bindings):
+            return row
+
+
 class ExprList(list, Expr, Parenthesizing):
     _no_sequence = object()
 
@@ -205,29 +395,40 @@ class ExprList(list, Expr, Parenthesizing):
 
     __rmul__ = __mul__
 
-    def sql(self):
-        items = ((item.sql(), isinstance(item, Parenthesizing))
-                 for item in self)
-        return ', '.join(
-            '(%s)' % (sql,) if paren else sql
-            for sql, paren in items
-        )
-
-    def args(self):
-        args = []
+    def _compile(self, sql, args):
+        separator = None
         for item in self:
-            args.extend(item.args())
-        return tuple(args)
+            if separator is None:
+                separator = ', '
+            else:
+                sql.append(separator)
+            _compile_operand(item, sql, args)
 
 
 class Asc(Expr):
-    def sql(self):
-        return super(Asc, self).sql() + ' asc'
+    def _compile(self, sql, args):
+        super(Asc, self)._compile(sql, args)
+        sql.append(' asc')
 
 
 class Desc(Expr):
-    def sql(self):
-        return super(Desc, self).sql() + ' desc'
+    def _compile(self, sql, args):
+        super(Desc, self)._compile(sql, args)
+        sql.append(' desc')
+
+
+class LeftJoin(Expr):
+    def __init__(self, left, right, on):
+        self.left = left
+        self.right = right
+        self.on = on
+
+    def _compile(self, sql, args):
+        _compile(self.left, sql, args)
+        sql.append(' left join ')
+        _compile(self.right, sql, args)
+        sql.append(' on ')
+        _compile(self.on, sql, args)
 
 
 class Limit(Sql):
@@ -268,10 +469,112 @@ class Limit(Sql):
             return 'limit %d, -1' % (self.offset,)
         return 'limit %d, %d' % (self.offset, self.limit)
 
+    def _compile(self, sql, args):
+        sql.append(self.sql())
+
+
+def _compile_limit(limit, sql, args):
+    limit_sql = []
+    _compile(limit, limit_sql, args)
+    limit_sql = ''.join(limit_sql)
+    if limit_sql:
+        sql.append(' ' + limit_sql)
+
+
+def _keyset(by):
+    if not isinstance(by, (list, tuple)):
+        by = (by,)
+    columns = []
+    descending = None
+    for item in by:
+        desc = isinstance(item, Desc)
+        if desc or isinstance(item, Asc):
+            item = item.value
+        if descending is None:
+            descending = desc
+        elif desc != descending:
+            raise TypeError('all keys must be sorted in the same direction')
+        columns.append(item)
+    return tuple(by), columns, descending
+
+
+class Page(list):
+    token = None
+
+
+class ResultSet(object):
+    def __init__(self, query, rows=None):
+        self.query = query
+        self._results = None
+        if rows is None:
+            self._rows = []
+            self._done = False
+        else:
+            self._rows = list(rows)
+            self._done = True
+
+    def _fill(self, n=None):
+        if self._done or (n is not None and len(self._rows) >= n):
+            return
+        if self._results is None:
+            self._results = self.query._results(self.query.execute())
+        rows = self._rows
+        for row in self._results:
+            rows.append(row)
+            if n is not None and len(rows) >= n:
+                return
+        self._done = True
+        self._results = None
+
+    def fill(self):
+        self._fill()
+        return self
+
+    def __len__(self):
+        self._fill()
+        return len(self._rows)
+
+    def __nonzero__(self):
+        self._fill(1)
+        return bool(self._rows)
+
+    def __getitem__(self, y):
+        if isinstance(y, slice):
+            if (
+                y.stop is None or y.stop < 0 or
+                (y.start is not None and y.start < 0)
+            ):
+                self._fill()
+            else:
+                self._fill(y.stop)
+        elif y < 0:
+            self._fill()
+        else:
+            self._fill(y + 1)
+        return self._rows[y]
+
+    def __iter__(self):
+        i = 0
+        while True:
+            if i < len(self._rows):
+                yield self._rows[i]
+                i += 1
+            elif self._done:
+                return
+            else:
+                self._fill(i + 1)
+
+    def __repr__(self):
+        return '<%s %r%s>' % (
+            self.__class__.__name__, self._rows,
+            '' if self._done else ' ...')
+
 
 class Select(Expr, Parenthesizing):
+    readonly = True
+
     def __init__(self, what=None, sources=None,
-                 where=None, order=None, limit=None):
+                 where=None, order=None, limit=None, batch_size=None):
         if what is None:
             if sources is None:
                 raise TypeError('must specify sources if not specifying what')
@@ -282,24 +585,71 @@ class Select(Expr, Parenthesizing):
         self.where = where
         self.order = order
         self.limit = limit
+        self.batch_size = batch_size
 
     def order_by(self, *args):
         if args:
             order = ExprList(args)
         else:
             order = None
-        return type(self)(
-            self.what, self.sources, self.where, order, self.limit)
+        return self._copy(order=order)
+
+    def batched(self, size):
+        return self._copy(batch_size=size)
+
+    def _copy(self, **changes):
+        q = self.__class__.__new__(self.__class__)
+        q.__dict__.update(self.__dict__)
+        q.__dict__.update(changes)
+        return q
 
     def find(self, where, *ands):
         if not isinstance(where, Expr):
             where = Expr(where)
         if ands:
-            where = reduce(And, ands, where)
+            where = And(where, *ands)
         if self.where:
             where = self.where & where
-        return type(self)(
-            self.what, self.sources, where, self.order, self.limit)
+        return self._copy(where=where)
+
+    def after(self, by, key):
+        by, columns, descending = _keyset(by)
+        if not isinstance(key, (list, tuple)):
+            key = (key,)
+        if len(key) != len(columns):
+            raise TypeError('expected %d key values, got %d' % (
+                len(columns), len(key)))
+        if len(columns) == 1:
+            lvalue, rvalue = columns[0], key[0]
+        else:
+            lvalue, rvalue = ExprList(columns), ExprList(key)
+        where = Lt(lvalue, rvalue) if descending else Gt(lvalue, rvalue)
+        return self.find(where).order_by(*by)
+
+    def paginate(self, by, page_size, token=None):
+        if token is None:
+            q = self.order_by(*_keyset(by)[0])
+        else:
+            q = self.after(by, json.loads(base64.urlsafe_b64decode(
+                str(token))))
+        rows = list(iter(q[:page_size + 1]))
+        page = Page(rows[:page_size])
+        if len(rows) > page_size:
+            page.token = base64.urlsafe_b64encode(json.dumps(
+                self._key(page[-1], _keyset(by)[1])))
+        return page
+
+    def _key(self, row, columns):
+        what = self.what if isinstance(self.what, ExprList) else [self.what]
+        key = []
+        for column in columns:
+            for i, item in enumerate(what):
+                if item is column:
+                    key.append(row[i])
+                    break
+            else:
+                raise TypeError('key columns must be selected')
+        return key
 
     def delete(self):
         return Delete(self.sources, self.where, self.order, self.limit)
@@ -321,45 +671,62 @@ class Select(Expr, Parenthesizing):
         return n
 
     def __iter__(self):
-        return iter(self.execute())
+        return self._results(self.execute())
+
+    def _results(self, cur):
+        if self.batch_size is not None:
+            return chain.from_iterable(self._batches(cur, self.batch_size))
+        hydrate = self._hydrator()
+        if hydrate is None:
+            return iter(cur)
+        return imap(hydrate, cur)
+
+    def _hydrator(self):
+        return None
+
+    def _batches(self, cur, size):
+        while True:
+            rows = cur.fetchmany(size)
+            if not rows:
+                break
+            hydrate = self._hydrator()
+            yield rows if hydrate is None else map(hydrate, rows)
+
+    def iter_batches(self, size=None):
+        if size is None:
+            size = self.batch_size or 1000
+        return self._batches(self.execute(), size)
+
+    def cached(self):
+        return ResultSet(self)
+
+    def fetch(self):
+        return ResultSet(self).fill()
 
     def __getitem__(self, y):
-        q = type(self)(self.what, self.sources, self.where, self.order)
         if isinstance(y, (int, long)):
-            q.limit = Limit(slice(y, y + 1))
+            q = self._copy(limit=Limit(slice(y, y + 1)))
             try:
                 return iter(q).next()
             except StopIteration:
                 raise IndexError(y)
         else:
-            q.limit = Limit(y)
-            return q
+            return self._copy(limit=Limit(y))
 
-    def sql(self):
-        sql = 'select ' + self.what.sql()
-        if self.sources is not None:
-            sql += ' from ' + self.sources.sql()
-        if self.where is not None:
-            sql += ' where ' + self.where.sql()
-        if self.order is not None:
-            sql += ' order by ' + self.order.sql()
-        if self.limit is not None:
-            limit = self.limit.sql()
-            if limit:
-                sql += ' ' + limit
-        return sql
-
-    def args(self):
-        args = list(self.what.args())
+    def _compile(self, sql, args):
+        sql.append('select ')
+        self.what._compile(sql, args)
         if self.sources is not None:
-            args.extend(self.sources.args())
+            sql.append(' from ')
+            _compile(self.sources, sql, args)
         if self.where is not None:
-            args.extend(self.where.args())
+            sql.append(' where ')
+            _compile(self.where, sql, args)
         if self.order is not None:
-            args.extend(self.order.args())
+            sql.append(' order by ')
+            _compile(self.order, sql, args)
         if self.limit is not None:
-            args.extend(self.limit.args())
-        return tuple(args)
+            _compile_limit(self.limit, sql, args)
 
 
 class Delete(Expr):
@@ -378,31 +745,38 @@ class Delete(Expr):
             order = None
         return type(self)(self.sources, self.where, order, self.limit)
 
-    def sql(self):
-        sql = 'delete from ' + self.sources.sql()
+    def _compile(self, sql, args):
+        sql.append('delete from ')
+        _compile(self.sources, sql, args)
         if self.where is not None:
-            sql += ' where ' + self.where.sql()
+            sql.append(' where ')
+            _compile(self.where, sql, args)
         if self.order is not None:
-            sql += ' order by ' + self.order.sql()
+            sql.append(' order by ')
+            _compile(self.order, sql, args)
         if self.limit is not None:
-            limit = self.limit.sql()
-            if limit:
-                sql += ' ' + limit
-        return sql
+            _compile_limit(self.limit, sql, args)
 
-    def args(self):
-        args = list(self.sources.args())
-        if self.where is not None:
-            args.extend(self.where.args())
-        if self.order is not None:
-            args.extend(self.order.args())
-        if self.limit is not None:
-            args.extend(self.limit.args())
-        return tuple(args)
+
+class OnConflict(Expr):
+    def __init__(self, target, update=()):
+        self.target = tuple(target)
+        self.update = tuple(update)
+
+    def _compile(self, sql, args):
+        sql.append(' on conflict (%s)' % (
+            ', '.join('"%s"' % (name,) for name in self.target),))
+        if not self.update:
+            sql.append(' do nothing')
+            return
+        sql.append(' do update set ')
+        sql.append(', '.join(
+            '"%s" = excluded."%s"' % (name, name) for name in self.update))
 
 
 class Insert(Expr):
-    def __init__(self, model, columns=None, values=None, on_conflict=None):
+    def __init__(self, model, columns=None, values=None, on_conflict=None,
+                 returning=None):
         self.model = model
         if columns is None and values is not None:
             if not isinstance(values, Select):
@@ -411,30 +785,35 @@ class Insert(Expr):
         self.columns = columns
         self.values = values
         self.on_conflict = on_conflict
-
-    def sql(self):
-        sql = 'insert'
-        if self.on_conflict is not None:
-            sql += ' or ' + self.on_conflict
-        sql += ' into ' + self.model.sql()
+        self.returning = returning
+
+    def _compile(self, sql, args):
+        sql.append('insert')
+        if isinstance(self.on_conflict, basestring):
+            sql.append(' or ' + self.on_conflict)
+        sql.append(' into ')
+        _compile(self.model, sql, args)
         if self.values is None:
-            sql += ' default values'
-            return sql
-        if self.columns is not None:
-            sql += ' (' + self.columns.sql() + ')'
-        if isinstance(self.values, Select):
-            sql += ' ' + self.values.sql()
+            sql.append(' default values')
+            if self.columns is not None:
+                _compile(self.columns, [], args)
         else:
-            sql += ' values (' + self.values.sql() + ')'
-        return sql
-
-    def args(self):
-        args = list(self.model.args())
-        if self.columns is not None:
-            args.extend(self.columns.args())
-        if self.values is not None:
-            args.extend(self.values.args())
-        return tuple(args)
+            if self.columns is not None:
+                sql.append(' (')
+                _compile(self.columns, sql, args)
+                sql.append(')')
+            if isinstance(self.values, Select):
+                sql.append(' ')
+                self.values._compile(sql, args)
+            else:
+                sql.append(' values (')
+                _compile(self.values, sql, args)
+                sql.append(')')
+        if isinstance(self.on_conflict, OnConflict):
+            self.on_conflict._compile(sql, args)
+        if self.returning is not None:
+            sql.append(' returning ')
+            _compile(self.returning, sql, args)
 
 
 class Update(Expr):
@@ -445,23 +824,27 @@ class Update(Expr):
         self.where = where
         self.on_conflict = on_conflict
 
-    def sql(self):
-        sql = 'update'
+    def _compile(self, sql, args):
+        sql.append('update')
         if self.on_conflict is not None:
-            sql += ' or ' + self.on_conflict
-        sql += ' ' + self.model.sql()
-        sql += ' set ' + ExprList(
-            Sql('%s = %s' % (column.sql(), value.sql()))
-            for column, value in zip(self.columns, self.values)
-        ).sql()
-        if self.where is not None:
-            sql += ' where ' + self.where.sql()
-        return sql
-
-    def args(self):
-        args = list(self.model.args())
-        args.extend(self.columns.args())
-        args.extend(self.values.args())
+            sql.append(' or ' + self.on_conflict)
+        sql.append(' ')
+        _compile(self.model, sql, args)
+        sql.append(' set ')
+        # arguments go columns first, then values
+        column_args = []
+        value_args = []
+        separator = None
+        for column, value in zip(self.columns, self.values):
+            if separator is None:
+                separator = ', '
+            else:
+                sql.append(separator)
+            column._compile(sql, column_args)
+            sql.append(' = ')
+            value._compile(sql, value_args)
+        args.extend(column_args)
+        args.extend(value_args)
         if self.where is not None:
-            args.extend(self.where.args())
-        return tuple(args)
+            sql.append(' where ')
+            _compile(self.where, sql, args)
@@ -1,8 +1,13 @@
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 from ..util import *
 
 import orm.connection
+import orm.executor
 
 
 class InvestorCompany(orm.model.Model):
@@ -142,6 +147,209 @@ class TestOrm(SqlTestCase):
         self.assertColumnEqual(scott.person_id, 2)
         self.assertColumnEqual(scott.name, 'Scott')
 
+    def test_model_get(self):
+        scott = Person.get(2)
+        self.assertColumnEqual(scott.name, 'Scott')
+        self.assertEqual(Person.get(5), None)
+
+    def test_isin(self):
+        for strategy in ('expand', 'bucket', 'json'):
+            q = Person.find(
+                Person.person_id.isin(orm.query.InList([1, 3, 4], strategy))
+            ).order_by(Person.person_id)
+            self.assertEqual([p.name for p in q], ['Guido', 'Ramona'])
+        names = [u'Scott', u'Guido'] * 100
+        q = Person.find(Person.name.isin(names)).order_by(Person.person_id)
+        self.assertEqual([p.name for p in q], ['Guido', 'Scott'])
+
+    def test_paginate(self):
+        q = Employee.find()
+        by = (Employee.company_id, Employee.person_id)
+        with self.db:
+            self.db.execute(
+                'update person set company_id = 0 where company_id is null')
+        names = []
+        token = None
+        while True:
+            page = q.paginate(by, 2, token)
+            names.append([p.name for p in page])
+            token = page.token
+            if token is None:
+                break
+        self.assertEqual(names, [['Guido', 'Scott'], ['Ramona']])
+
+    def test_iter_batches(self):
+        q = Person.find().order_by(Person.person_id)
+        names = [[p.name for p in batch] for batch in q.iter_batches(2)]
+        self.assertEqual(names, [['Guido', 'Scott'], ['Ramona']])
+        self.assertEqual(
+            [p.name for p in q.batched(1)], ['Guido', 'Scott', 'Ramona'])
+
+    def test_scan(self):
+        self.assertEqual(
+            [p.name for p in Person.scan(chunk=2)],
+            ['Guido', 'Scott', 'Ramona'])
+        self.assertEqual(
+            [p.name for p in Person.scan(chunk=1, where=Person.person_id > 1)],
+            ['Scott', 'Ramona'])
+
+    def test_values(self):
+        q = Person.find(Person.person_id < 3).order_by(Person.person_id)
+        self.assertEqual(list(q.values(Person.name)), [('Guido',), ('Scott',)])
+        self.assertEqual(list(q.scalars(Person.name)), ['Guido', 'Scott'])
+        self.assertEqual(
+            [d['name'] for d in q.dicts()], ['Guido', 'Scott'])
+
+    def test_only(self):
+        q = Person.find().order_by(Person.person_id).only(Person.person_id)
+        people = list(iter(q))
+        self.assertFalse('name' in people[0].__dict__)
+        self.assertEqual([p.name for p in people], ['Guido', 'Scott', 'Ramona'])
+        people = list(iter(q.only(Person.person_id, batch=True)))
+        self.assertEqual(people[1].name, 'Scott')
+        self.assertTrue('name' in people[2].__dict__)
+        self.assertEqual([p.name for p in people], ['Guido', 'Scott', 'Ramona'])
+
+    def test_session(self):
+        with self.db:
+            self.db.execute('update person set company_id = 1')
+        with orm.model.Session():
+            companies = [e.company for e in Employee.find()]
+            self.assertEqual(len(companies), 3)
+            for company in companies:
+                self.assertTrue(company is companies[0])
+            self.assertTrue(Company.get(companies[0].company_id)
+                            is companies[0])
+
+    def test_join_load(self):
+        q = Employee.find().order_by(Employee.person_id)
+        employees = list(iter(q.join_load(Employee.company)))
+        self.assertEqual(
+            [e.name for e in employees], ['Guido', 'Scott', 'Ramona'])
+        for employee in employees:
+            self.assertTrue(Employee.company in employee.orm_related)
+            company = employee.company
+            if employee.company_id is None:
+                self.assertTrue(company is None)
+            else:
+                self.assertEqual(company.company_id, employee.company_id)
+                self.assertEqual(
+                    company.name, Company.get(employee.company_id).name)
+
+    def test_prefetch(self):
+        q = Company.find().order_by(Company.company_id)
+        expected = [
+            ([e.name for e in c.employees], [p.name for p in c.investors])
+            for c in q
+        ]
+        companies = list(iter(q.prefetch(Company.employees, Company.investors)))
+        for company in companies:
+            self.assertTrue(Company.employees in company.orm_related)
+            self.assertTrue(Company.investors in company.orm_related)
+        self.assertEqual([
+            ([e.name for e in c.employees], [p.name for p in c.investors])
+            for c in companies
+        ], expected)
+        self.assertTrue(any(names for names, _ in expected))
+        self.assertTrue(any(names for _, names in expected))
+
+    def test_insert_many(self):
+        knives = Person()
+        knives.name = 'Knives'
+        count = Person.insert_many(
+            [knives, dict(name='Wallace'), dict(name='Kim')],
+            assign_keys=True)
+        self.assertEqual(count, 3)
+        self.assertEqual(knives.person_id, knives.oid)
+        self.assertEqual(
+            Person.get(knives.person_id).name, 'Knives')
+        self.assertEqual(
+            [p.name for p in Person.find(Person.person_id > 3).order_by(
+                Person.person_id)],
+            ['Knives', 'Wallace', 'Kim'])
+
+    def test_insert_many_then_save(self):
+        knives = Person()
+        knives.name = 'Knives'
+        Person.insert_many([knives])
+        count = len(Person.find())
+        knives.name = 'Knives Chau'
+        knives.save()
+        self.assertEqual(
+            [p.name for p in Person.find(Person.name == 'Knives Chau')],
+            ['Knives Chau'])
+        knives.delete()
+        self.assertEqual(len(Person.find()), count - 1)
+
+    def test_save_reload_text_key(self):
+        class Code(orm.model.Model):
+            orm_table = 'code'
+            code = orm.model.Column(primary=True)
+            name = orm.model.Column()
+
+        with self.db:
+            self.db.cursor().execute(
+                "create table code (code text primary key default 'x', "
+                "name text)")
+        for reload in ('none', 'defaults'):
+            self.db.cursor().execute('delete from code')
+            code = Code()
+            code.name = reload
+            code.save(reload=reload)
+            self.assertEqual(code.code, 'x')
+            code.name = 'renamed'
+            code.save()
+            self.assertEqual(Code.get('x').name, 'renamed')
+
+    def test_save_reload(self):
+        for reload in ('returning', 'none', 'all'):
+            person = Person()
+            person.name = reload
+            person.save(reload=reload)
+            self.assertEqual(person.person_id, person.oid)
+            self.assertEqual(Person.get(person.person_id).name, reload)
+
+    def test_update(self):
+        with self.db:
+            count = Employee.find(Employee.company_id == 1).update(
+                company_id=Employee.company_id + 1, name='Moved')
+        self.assertEqual(count, len(Employee.find(Employee.company_id == 2)))
+        self.assertEqual(
+            [e.name for e in Employee.find(Employee.company_id == 2)],
+            ['Moved'] * count)
+        self.assertTrue(count > 0)
+
+    def test_upsert_many(self):
+        Company.upsert_many([
+            dict(company_id=1, name='Amazon'),
+            dict(company_id=10, name='New'),
+        ])
+        self.assertEqual(Company.get(1).name, 'Amazon')
+        self.assertEqual(Company.get(10).name, 'New')
+
+    def test_upsert_many_then_save(self):
+        class Tag(orm.model.Model):
+            orm_table = 'tag'
+            name = orm.model.Column()
+            hits = orm.model.Column()
+
+        with self.db:
+            self.db.cursor().executescript(
+                "create table tag (name text unique, hits integer);"
+                "insert into tag values ('a', 1);"
+                "insert into tag values ('b', 1);")
+        tag = Tag()
+        tag.name = 'a'
+        tag.hits = 2
+        Tag.upsert_many([tag], conflict=[Tag.name])
+        tag.hits = 3
+        tag.save()
+        self.assertEqual(
+            [(t.name, t.hits) for t in Tag.find().order_by(Tag.name)],
+            [('a', 3), ('b', 1)])
+        tag.delete()
+        self.assertEqual([t.name for t in Tag.find()], ['b'])
+
     def test_model_subclass(self):
         ramona = Employee.find(Employee.name == 'Ramona')[0]
         self.assertTrue(isinstance(ramona, Employee))
@@ -253,5 +461,115 @@ class TestOrm(SqlTestCase):
         self.assertColumnEqual(guido.name, 'Guido')
 
 
+class TestOrmPool(SqlTestCase):
+    def setUp(self):
+        orm.connection.reset()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'orm.db')
+        self.pool = orm.connection.set_pool(self.make_pool(self.path))
+        with orm.connection.transaction() as db:
+            db.cursor().executescript(
+                '''
+                create table person (
+                    person_id integer not null primary key autoincrement,
+                    name text not null,
+                    company_id integer
+                );
+                create table company (
+                    company_id integer not null primary key autoincrement,
+                    name text not null
+                );
+                insert into company (company_id, name) values (1, 'Amazon.ca');
+                insert into company (company_id, name) values (2, 'Google');
+                insert into person (person_id, name, company_id)
+                    values (1, 'Guido', 2);
+                insert into person (person_id, name, company_id)
+                    values (2, 'Ramona', 1);
+                '''
+            )
+
+    def make_pool(self, path):
+        return orm.connection.Pool(path, max_size=1, checkout_timeout=2)
+
+    def tearDown(self):
+        self.pool.close()
+        orm.connection.reset()
+        shutil.rmtree(self.dir)
+
+    def test_list(self):
+        # list() asks for len() while the select's cursor is still open
+        self.assertEqual(
+            [p.name for p in list(Person.find().order_by(Person.person_id))],
+            ['Guido', 'Ramona'])
+
+    def test_nested_load(self):
+        self.assertEqual([
+            (e.name, e.company.name)
+            for e in Employee.find().order_by(Employee.person_id)
+        ], [('Guido', 'Google'), ('Ramona', 'Amazon.ca')])
+
+    def test_write_while_reading(self):
+        for person in Person.find():
+            person.name = person.name.upper()
+            person.save()
+        self.assertEqual(
+            sorted(p.name for p in Person.find()), ['GUIDO', 'RAMONA'])
+
+    def test_executor_connect(self):
+        # workers with their own connections commit what each job wrote
+        executor = orm.executor.Executor(self.path, threads=1)
+        try:
+            person = Person()
+            person.name = 'Scott'
+            executor.save(person).result(5)
+            self.assertEqual(
+                sorted(p.name for p in Person.find()),
+                ['Guido', 'Ramona', 'Scott'])
+            executor.execute(orm.query.Delete(
+                Person, Person.name == 'Scott')).result(5)
+            self.assertEqual(
+                sorted(p.name for p in Person.find()), ['Guido', 'Ramona'])
+        finally:
+            executor.shutdown()
+
+
+class TestOrmRouter(TestOrmPool):
+    def make_pool(self, path):
+        return orm.connection.Router(path, checkout_timeout=5)
+
+    def test_concurrent_nested_loads(self):
+        # as many threads as readers, each holding a reader's cursor open
+        # while it lazy-loads, and all of them doing so at once
+        n = 4
+        started = []
+        cond = threading.Condition()
+        def load():
+            res = []
+            for e in Employee.find().order_by(Employee.person_id):
+                with cond:
+                    started.append(e)
+                    cond.notify_all()
+                    while len(started) < n:
+                        cond.wait(5)
+                res.append(e.company.name)
+            return res
+        executor = orm.executor.Executor(threads=n)
+        try:
+            futures = [executor.submit(load) for i in xrange(n)]
+            for future in futures:
+                self.assertEqual(future.result(10), ['Google', 'Amazon.ca'])
+        finally:
+            executor.shutdown()
+        self.assertEqual(self.pool.readers.size, n)
+
+    def test_save_reload(self):
+        for reload in ('returning', 'none', 'defaults', 'all'):
+            person = Person()
+            person.name = reload
+            person.save(reload=reload)
+            self.assertEqual(person.person_id, person.oid)
+            self.assertEqual(Person.get(person.person_id).name, reload)
+
+
 if __name__ == "__main__":
     main(__name__)
@@ -1,23 +1,41 @@
+sqlite_version_info = (3, 24, 0)
+
+
 def reset():
     del Connection.instances[:]
 
 
+class Error(Exception):
+    pass
+
+
 class Cursor(object):
     def __init__(self, connection):
         self.connection = connection
         self.rows = []
+        self.pos = 0
 
     def __iter__(self):
         return iter(self.rows)
 
     def execute(self, sql, args=()):
+        if self.connection.closed:
+            raise Error('cannot operate on a closed database')
         self.connection.statements.append((sql, args))
         self.rows = self.connection.rows
+        self.rowcount = self.connection.rowcount
+        self.pos = 0
 
     def executemany(self, sql, args):
         self.connection.many_statements.append((sql, args))
         self.rows = self.connection.rows
 
+    def fetchmany(self, size=1):
+        self.connection.fetches.append(size)
+        rows = self.rows[self.pos:self.pos + size]
+        self.pos += len(rows)
+        return rows
+
     def fetchone(self):
         if self.rows:
             return self.rows[0]
@@ -31,17 +49,43 @@ class Cursor(object):
 class Connection(object):
     instances = []
 
-    def __init__(self, path):
+    def __init__(self, path, **kwargs):
         Connection.instances.append(self)
         self.path = path
+        self.kwargs = kwargs
         self.rows = []
         self.statements = []
         self.many_statements = []
+        self.fetches = []
+        self.rowcount = -1
         self.lastrowid = None
+        self.commits = 0
+        self.rollbacks = 0
+        self.closed = False
 
-    def cursor(self):
+    def cursor(self, factory=None):
         return Cursor(self)
 
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        if self.closed:
+            raise Error('cannot operate on a closed database')
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
 
-def connect(path):
-    return Connection(path)
+def connect(path, **kwargs):
+    return Connection(path, **kwargs)
@@ -28,6 +28,15 @@ class TestConnection(unittest.TestCase):
         con = connection.connect(':memory:')
         self.assertEqual(connection.get_connection(), con)
 
+    def test_transaction(self):
+        self.assertRaises(RuntimeError, connection.transaction().__enter__)
+        con = connection.connect(':memory:')
+        with connection.transaction() as con2:
+            self.assertTrue(con2 is con)
+            with connection.borrow(True) as con3:
+                self.assertTrue(con3 is con)
+        self.assertEqual(con.commits, 1)
+
     def test_connection_is_threadlocal(self):
         def do_it(i, res, cond1, cond2):
             with cond1:
@@ -54,5 +63,267 @@ class TestConnection(unittest.TestCase):
         self.assertEqual(set(res), set(xrange(3)), res)
 
 
+class TestPool(unittest.TestCase):
+    def setUp(self):
+        connection.sqlite3 = sqlite3
+        sqlite3.reset()
+        connection.reset()
+
+    def tearDown(self):
+        connection.sqlite3 = sys.modules['sqlite3']
+
+    def test_checkout_checkin(self):
+        pool = connection.Pool(':memory:')
+        con = pool.checkout()
+        self.assertEqual([con], sqlite3.Connection.instances)
+        self.assertEqual(con.kwargs, {'check_same_thread': False})
+        pool.checkin(con)
+        self.assertEqual(con.rollbacks, 1)
+        self.assertTrue(pool.checkout() is con)
+        self.assertEqual(pool.size, 1)
+        self.assertEqual(pool.stats['connects'], 1)
+        self.assertEqual(pool.stats['checkouts'], 2)
+        self.assertEqual(pool.stats['checkins'], 1)
+
+    def test_max_size_timeout(self):
+        pool = connection.Pool(':memory:', max_size=2, checkout_timeout=0.01)
+        pool.checkout()
+        pool.checkout()
+        self.assertRaises(RuntimeError, pool.checkout)
+        self.assertEqual(pool.size, 2)
+        self.assertEqual(pool.stats['waits'], 1)
+        self.assertTrue(pool.stats['wait_time'] > 0)
+
+    def test_connect_timeout(self):
+        pool = connection.Pool(
+            ':memory:', max_size=1, timeout=3, checkout_timeout=0.01)
+        con = pool.checkout()
+        self.assertEqual(
+            con.kwargs, {'check_same_thread': False, 'timeout': 3})
+        self.assertRaises(RuntimeError, pool.checkout)
+
+    def test_wait_for_checkin(self):
+        pool = connection.Pool(':memory:', max_size=1)
+        con = pool.checkout()
+        t = threading.Timer(0.01, pool.checkin, (con,))
+        t.start()
+        self.assertTrue(pool.checkout(timeout=5) is con)
+        t.join()
+        self.assertEqual(pool.stats['waits'], 1)
+
+    def test_setup_hooks(self):
+        pool = connection.Pool(':memory:', setup=[
+            lambda con: con.cursor().execute('pragma foreign_keys = on'),
+        ])
+        con = pool.checkout()
+        self.assertEqual(con.statements, [('pragma foreign_keys = on', ())])
+
+    def test_idle_eviction(self):
+        pool = connection.Pool(':memory:', max_idle=0)
+        con = pool.checkout()
+        pool.checkin(con)
+        self.assertTrue(con.closed)
+        self.assertEqual(pool.size, 0)
+        self.assertEqual(pool.stats['evictions'], 1)
+        self.assertFalse(pool.checkout() is con)
+
+    def test_check(self):
+        pool = connection.Pool(':memory:', check=True)
+        con = pool.checkout()
+        pool.checkin(con)
+        self.assertTrue(pool.checkout() is con)
+        pool.checkin(con)
+        con.close()
+        con2 = pool.checkout()
+        self.assertFalse(con2 is con)
+        self.assertEqual(pool.size, 1)
+        self.assertEqual(pool.stats['failed_checks'], 1)
+
+    def test_context_manager(self):
+        pool = connection.Pool(':memory:')
+        with pool.connection() as con:
+            self.assertTrue(pool.leased() is con)
+            with pool.connection() as con2:
+                self.assertTrue(con2 is con)
+            self.assertEqual(pool.idle, [])
+        self.assertEqual([c for c, t in pool.idle], [con])
+
+    def test_get_connection(self):
+        pool = connection.set_pool(connection.Pool(':memory:'))
+        con = connection.get_connection()
+        self.assertTrue(connection.get_connection() is con)
+        self.assertEqual(pool.size, 1)
+        connection.release()
+        self.assertEqual([c for c, t in pool.idle], [con])
+        own = connection.connect(':memory:')
+        self.assertTrue(connection.get_connection() is own)
+
+    def test_thread_exit_returns_connection(self):
+        pool = connection.set_pool(connection.Pool(':memory:', max_size=1))
+        res = []
+        for i in xrange(3):
+            t = threading.Thread(
+                target=lambda: res.append(connection.get_connection()))
+            t.start()
+            t.join()
+        self.assertEqual(len(sqlite3.Connection.instances), 1)
+        self.assertEqual(res, sqlite3.Connection.instances * 3)
+        self.assertTrue(pool.checkout(timeout=5) is res[0])
+
+    def test_execute_returns_connection(self):
+        pool = connection.set_pool(connection.Pool(':memory:', max_size=1))
+        cur = connection.execute('select 1', readonly=True)
+        con = cur.connection
+        self.assertEqual(pool.idle, [])
+        self.assertTrue(pool.leased() is con)
+        del cur
+        self.assertEqual(pool.leased(), None)
+        self.assertEqual([c for c, t in pool.idle], [con])
+        connection.execute('insert into t default values')
+        self.assertEqual(con.commits, 1)
+        self.assertEqual(pool.stats['checkins'], 2)
+
+    def test_execute_does_not_pin_threads(self):
+        pool = connection.set_pool(connection.Pool(
+            ':memory:', max_size=2, checkout_timeout=5))
+        done = threading.Event()
+        def query():
+            connection.execute('select 1', readonly=True).fetchone()
+            done.wait(5)
+        threads = [threading.Thread(target=query) for i in xrange(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(0.05)
+        self.assertEqual(pool.stats['checkouts'], 3)
+        self.assertEqual(pool.stats['checkins'], 3)
+        done.set()
+        for t in threads:
+            t.join()
+
+    def test_execute_shares_thread_connection(self):
+        pool = connection.set_pool(connection.Pool(
+            ':memory:', max_size=1, checkout_timeout=0.01))
+        cur1 = connection.execute('select 1', readonly=True)
+        cur2 = connection.execute('select 2', readonly=True)
+        self.assertTrue(cur2.connection is cur1.connection)
+        with connection.borrow() as con:
+            self.assertTrue(con is cur1.connection)
+        self.assertEqual(con.commits, 1)
+        del cur1
+        self.assertEqual(pool.idle, [])
+        del cur2
+        self.assertEqual([c for c, t in pool.idle], [con])
+        self.assertEqual(pool.stats['checkouts'], 1)
+
+    def test_lease_outlives_cursors(self):
+        pool = connection.set_pool(connection.Pool(':memory:', max_size=1))
+        cur = connection.execute('select 1', readonly=True)
+        con = connection.get_connection()
+        self.assertTrue(con is cur.connection)
+        del cur
+        self.assertTrue(pool.leased() is con)
+        connection.release()
+        self.assertEqual([c for c, t in pool.idle], [con])
+
+    def test_execute_in_transaction(self):
+        pool = connection.set_pool(connection.Pool(':memory:'))
+        with connection.transaction() as con:
+            cur = connection.execute('select 1', readonly=True)
+            self.assertTrue(cur.connection is con)
+            connection.execute('insert into t default values')
+            self.assertEqual(con.commits, 0)
+        self.assertEqual(con.commits, 1)
+        self.assertEqual(pool.size, 1)
+
+
+class TestRouter(unittest.TestCase):
+    def setUp(self):
+        connection.sqlite3 = sqlite3
+        sqlite3.reset()
+        connection.reset()
+
+    def tearDown(self):
+        connection.sqlite3 = sys.modules['sqlite3']
+
+    def test_setup(self):
+        router = connection.Router('some.db', readers=2)
+        self.assertEqual(router.writer.max_size, 1)
+        self.assertEqual(router.readers.max_size, 2)
+        writer = router.writer.checkout()
+        reader = router.readers.checkout()
+        self.assertEqual(
+            writer.statements, [('pragma journal_mode = wal', ())])
+        self.assertEqual(reader.statements, [('pragma query_only = on', ())])
+
+    def test_borrow_readonly(self):
+        router = connection.set_pool(connection.Router('some.db'))
+        with connection.borrow(True) as con:
+            self.assertTrue(router.readers.leased() is con)
+        self.assertEqual(router.readers.leased(), None)
+        self.assertEqual([c for c, t in router.readers.idle], [con])
+        self.assertEqual(router.writer.size, 0)
+
+    def test_reads_do_not_pin_threads(self):
+        router = connection.set_pool(connection.Router(
+            'some.db', readers=1, checkout_timeout=5))
+        res = []
+        done = threading.Event()
+        def read():
+            res.append(connection.execute('select 1', readonly=True).connection)
+            with connection.borrow(True) as con:
+                res.append(con)
+            done.wait(5)
+        threads = [threading.Thread(target=read) for i in xrange(3)]
+        for t in threads:
+            t.start()
+            t.join(0.05)
+        self.assertEqual(len(res), 6)
+        self.assertEqual(router.readers.size, 1)
+        self.assertEqual(router.readers.stats['checkins'], 6)
+        done.set()
+        for t in threads:
+            t.join()
+
+    def test_borrow_write(self):
+        router = connection.set_pool(connection.Router('some.db'))
+        with connection.borrow() as con:
+            self.assertTrue(router.writer.leased() is con)
+        self.assertEqual(con.commits, 1)
+        self.assertEqual(router.writer.leased(), None)
+        self.assertEqual(router.readers.size, 0)
+
+    def test_borrow_write_error(self):
+        router = connection.set_pool(connection.Router('some.db'))
+        def do_it():
+            with connection.borrow() as con:
+                raise ValueError
+        self.assertRaises(ValueError, do_it)
+        con = router.writer.checkout()
+        self.assertEqual((con.commits, con.rollbacks), (0, 1))
+
+    def test_transaction_reads_own_writes(self):
+        router = connection.set_pool(connection.Router('some.db'))
+        with connection.transaction() as con:
+            with connection.borrow(True) as con2:
+                self.assertTrue(con2 is con)
+            self.assertTrue(connection.get_connection() is con)
+        self.assertEqual(router.readers.size, 0)
+
+    def test_writes_are_serialized(self):
+        router = connection.set_pool(connection.Router('some.db'))
+        res = []
+        def write():
+            with connection.borrow():
+                res.append('other')
+        with connection.transaction():
+            t = threading.Thread(target=write)
+            t.start()
+            t.join(0.05)
+            res.append('mine')
+        t.join()
+        self.assertEqual(res, ['mine', 'other'])
+
+
 if __name__ == "__main__":
     main(__name__)
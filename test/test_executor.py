@@ -0,0 +1,262 @@
+import sys
+import unittest
+import threading
+
+from .util import *
+from .fakes import sqlite3
+
+from orm import connection
+from orm.query import *
+from orm.model import *
+from orm.executor import *
+
+
+class ExecutorModel(Model):
+    orm_table = 'executor_table'
+    column1 = Column('some_column', primary=True)
+    column2 = Column('other_column')
+
+# column1, column2
+ExecutorModel.orm_columns.sort(key=lambda x: x.attr)
+
+
+class TestFuture(unittest.TestCase):
+    def test_result(self):
+        future = Future()
+        res = []
+        future.add_done_callback(res.append)
+        self.assertFalse(future.done())
+        self.assertRaises(RuntimeError, future.result, 0)
+        future.set_result(1)
+        self.assertTrue(future.done())
+        self.assertEqual(future.result(), 1)
+        self.assertEqual(future.exception(), None)
+        self.assertEqual(res, [future])
+        future.add_done_callback(res.append)
+        self.assertEqual(res, [future, future])
+
+    def test_exception(self):
+        future = Future()
+        try:
+            raise ValueError('oops')
+        except ValueError:
+            future.set_exception(sys.exc_info())
+        self.assertRaises(ValueError, future.result)
+        self.assertTrue(isinstance(future.exception(), ValueError))
+
+
+class TestExecutor(unittest.TestCase):
+    def setUp(self):
+        connection.sqlite3 = sqlite3
+        sqlite3.reset()
+        connection.reset()
+        self.pool = connection.set_pool(connection.Pool(':memory:'))
+        self.db = self.pool.checkout()
+        self.pool.checkin(self.db)
+        self.executor = Executor(threads=1)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        connection.sqlite3 = sys.modules['sqlite3']
+
+    def test_submit(self):
+        thread = self.executor.submit(threading.current_thread).result(5)
+        self.assertFalse(thread is threading.current_thread())
+        future = self.executor.submit(int, 'x')
+        self.assertRaises(ValueError, future.result, 5)
+
+    def test_own_connections(self):
+        self.executor.shutdown()
+        self.executor = Executor(':memory:', threads=2)
+        con = self.executor.submit(connection.get_connection).result(5)
+        self.assertFalse(con is self.db)
+        self.assertEqual(con.path, ':memory:')
+
+    def test_connection_released_after_job(self):
+        self.executor.shutdown()
+        self.executor = Executor(threads=2)
+        self.pool.max_size = 1
+        self.pool.checkout_timeout = 5
+        futures = [self.executor.submit(connection.get_connection)
+                   for i in xrange(4)]
+        self.assertEqual([f.result(5) for f in futures], [self.db] * 4)
+        self.assertEqual(self.pool.idle[0][0], self.db)
+        self.assertEqual(self.pool.stats['checkins'], 5)
+
+    def test_fetch(self):
+        self.db.rows = rows = [('row1_1', 'row1_2'), ('row2_1', 'row2_2')]
+        res = self.executor.fetch(ExecutorModel.find()).result(5)
+        self.assertEqual([obj.column1 for obj in res], ['row1_1', 'row2_1'])
+        self.assertEqual(self.db.statements, [(
+            'select "executor_table"."some_column", '
+            '"executor_table"."other_column", "executor_table"."oid" '
+            'from "executor_table"',
+            ()
+        )])
+
+    def test_first(self):
+        self.db.rows = [('row1_1', 'row1_2')]
+        obj = self.executor.first(ExecutorModel.find()).result(5)
+        self.assertEqual(obj.column1, 'row1_1')
+        self.db.rows = []
+        future = self.executor.first(ExecutorModel.find())
+        self.assertEqual(future.result(5), None)
+
+    def test_count(self):
+        self.db.rows = [(5,)]
+        future = self.executor.count(ExecutorModel.find())
+        self.assertEqual(future.result(5), 5)
+
+    def test_save(self):
+        obj = ExecutorModel()
+        obj.orm_new = False
+        obj.__dict__['column1'] = 'old1'
+        obj.column2 = 'world'
+        self.executor.save(obj).result(5)
+        self.assertEqual(obj.orm_dirty, {})
+        self.assertEqual(self.db.statements, [(
+            'update "executor_table" set "other_column" = ? '
+            'where "executor_table"."some_column" = ?',
+            ('world', 'old1')
+        )])
+
+    def test_stream(self):
+        self.db.rows = rows = [(i,) for i in xrange(5)]
+        futures = list(self.executor.stream(Select(sources=Sql('t')), 2))
+        self.assertEqual(
+            [f.result(5) for f in futures], [rows[0:2], rows[2:4], rows[4:]])
+        futures = list(self.executor.stream(Select(sources=Sql('t')), 5))
+        self.assertEqual([f.result(5) for f in futures], [rows])
+        self.db.rows = []
+        futures = list(self.executor.stream(Select(sources=Sql('t'))))
+        self.assertEqual([f.result(5) for f in futures], [[]])
+
+    def test_stream_does_not_block(self):
+        self.db.rows = rows = [(i,) for i in xrange(4)]
+        self.executor.shutdown()
+        self.executor = Executor(threads=1)
+        ready = threading.Event()
+        self.executor.submit(ready.wait, 5)
+        stream = self.executor.stream(Select(sources=Sql('t')), 2)
+        # the worker is busy, yet the consumer gets a future to wait on
+        future = stream.next()
+        self.assertRaises(RuntimeError, future.result, 0.01)
+        ready.set()
+        self.assertEqual(future.result(5), rows[:2])
+        self.assertEqual(stream.next().result(5), rows[2:])
+        self.assertRaises(StopIteration, stream.next)
+
+    def test_stream_close(self):
+        self.db.rows = [(i,) for i in xrange(10)]
+        stream = self.executor.stream(Select(sources=Sql('t')), 1, 1)
+        self.assertEqual(stream.next().result(5), [(0,)])
+        stream.close()
+        # the worker gives up on the abandoned stream
+        self.assertEqual(self.executor.submit(lambda: 1).result(5), 1)
+
+    def test_stream_error(self):
+        class Broken(Select):
+            def __iter__(self):
+                raise ValueError
+        future, = self.executor.stream(Broken(1))
+        self.assertRaises(ValueError, future.result, 5)
+
+
+class TestWriteQueue(unittest.TestCase):
+    def setUp(self):
+        connection.sqlite3 = sqlite3
+        sqlite3.reset()
+        connection.reset()
+
+    def tearDown(self):
+        ExecutorModel.orm_write_queue = None
+        connection.sqlite3 = sys.modules['sqlite3']
+
+    def make_obj(self, value):
+        obj = ExecutorModel()
+        obj.orm_new = False
+        obj.__dict__['column1'] = value
+        obj.column2 = value
+        return obj
+
+    def test_group_commit(self):
+        queue = WriteQueue(':memory:', max_batch=3, max_delay=5)
+        objs = [self.make_obj(i) for i in xrange(4)]
+        futures = [queue.save(obj) for obj in objs]
+        queue.close()
+        for future in futures:
+            self.assertEqual(future.result(5), None)
+        for obj in objs:
+            self.assertEqual(obj.orm_dirty, {})
+        db, = sqlite3.Connection.instances
+        self.assertEqual(len(db.statements), 4)
+        self.assertEqual(db.commits, 2)
+        self.assertEqual(queue.stats, dict(writes=4, batches=2, retries=0))
+
+    def test_failure_is_isolated(self):
+        queue = WriteQueue(':memory:', max_delay=5, max_batch=3)
+        obj1 = self.make_obj(1)
+        obj2 = self.make_obj(2)
+        f1 = queue.save(obj1)
+        f2 = queue.submit(int, 'x')
+        f3 = queue.save(obj2)
+        queue.close()
+        self.assertEqual(f1.result(5), None)
+        self.assertRaises(ValueError, f2.result, 5)
+        self.assertEqual(f3.result(5), None)
+        db, = sqlite3.Connection.instances
+        self.assertEqual(db.rollbacks, 2)
+        self.assertEqual(db.commits, 2)
+        # the first batch was rolled back and retried
+        self.assertEqual(len(db.statements), 3)
+        self.assertEqual(db.statements[0], db.statements[1])
+        self.assertEqual(obj1.orm_dirty, {})
+        self.assertEqual(queue.stats['retries'], 1)
+
+    def test_model_save(self):
+        ExecutorModel.orm_write_queue = queue = WriteQueue(':memory:')
+        obj = self.make_obj('x')
+        obj.save()
+        self.assertEqual(obj.orm_dirty, {})
+        obj.delete()
+        self.assertTrue(obj.orm_new)
+        queue.close()
+        db, = sqlite3.Connection.instances
+        self.assertEqual(len(db.statements), 2)
+        self.assertEqual(db.commits, 2)
+
+    def test_model_save_from_queue(self):
+        ExecutorModel.orm_write_queue = queue = WriteQueue(':memory:')
+        obj = self.make_obj('x')
+        self.assertEqual(queue.submit(obj.save).result(5), None)
+        self.assertEqual(obj.orm_dirty, {})
+        queue.submit(obj.delete).result(5)
+        self.assertTrue(obj.orm_new)
+        queue.close()
+        db, = sqlite3.Connection.instances
+        self.assertEqual(len(db.statements), 2)
+        self.assertEqual(db.commits, 2)
+
+    def test_model_save_in_transaction(self):
+        connection.set_pool(connection.Router(':memory:'))
+        ExecutorModel.orm_write_queue = queue = WriteQueue()
+        obj = self.make_obj('x')
+        def save():
+            with connection.transaction() as db:
+                obj.save()
+                # the write joined the transaction instead of waiting on it
+                self.assertEqual(len(db.statements), 2)
+                self.assertEqual(db.commits, 0)
+                obj.delete()
+            return db
+        executor = Executor(threads=1)
+        db = executor.submit(save).result(5)
+        executor.shutdown()
+        queue.close()
+        self.assertEqual(len(db.statements), 3)
+        self.assertEqual(db.commits, 1)
+        self.assertEqual(queue.stats['writes'], 0)
+
+
+if __name__ == "__main__":
+    main(__name__)
@@ -1,3 +1,4 @@
+import gc
 import sys
 import unittest
 
@@ -35,6 +36,12 @@ class SomeModelSomeModel(Model):
     m2_column1 = Column()
 
 
+class SomeModelDeferred(Model):
+    orm_table = 'some_table'
+    column1 = Column('some_column')
+    column2 = Column('other_column', deferred=True)
+
+
 class SomeModelAdapterConverter(Model):
     orm_table = 'some_table'
     column1 = Column('some_column', adapter=lambda x: x.upper())
@@ -59,7 +66,8 @@ class TestColumn(SqlTestCase):
         self.assertSqlEqual(column, '"some_table"."some_column"')
 
     def test_copy(self):
-        attrs = 'name attr model primary adapter converter'.split()
+        attrs = ('name attr model primary adapter converter deferred '
+                 'db_default').split()
         column1 = Column()
         for attr in attrs:
             setattr(column1, attr, object())
@@ -174,6 +182,25 @@ class TestToOne(SqlTestCase):
         obj = a1.find(a1.column1 == 'row1_1')[0].a2
         self.assertTrue(isinstance(obj, a2))
 
+    def test_get_prepared(self):
+        db = connection.connect(':memory:')
+        db.rows = [('row1_1', 'row1_2')]
+        a1 = SomeModel.as_alias('m1')
+        a2 = SomeModel.as_alias('m2')
+        a1.a2 = t = ToOne(a1.column2, a2.column1)
+        obj = a1.find()[0]
+        del db.statements[:]
+        obj.a2
+        statement = t.statement
+        obj.expire()
+        obj.a2
+        self.assertTrue(t.statement is statement)
+        sql = (
+            'select "m2"."some_column", "m2"."other_column", "m2"."oid" '
+            'from "some_table" "m2" where "m2"."some_column" = ? limit 0, 1'
+        )
+        self.assertEqual(db.statements, [(sql, ('row1_2',))] * 2)
+
     def test_get_not_found(self):
         connection.connect(':memory:')
         connection.get_connection().rows = rows = [
@@ -244,6 +271,30 @@ class TestToOne(SqlTestCase):
         other_column = obj.__class__.__dict__['some_model'].other_column
         self.assertTrue(other_column is SomeModel.column1)
 
+    def test_memoize(self):
+        db = connection.connect(':memory:')
+        db.rows = [('row1_1', 'row1_2')]
+        a1 = SomeModel.as_alias('m1')
+        a2 = SomeModel.as_alias('m2')
+        a1.a2 = ToOne(a1.column2, a2.column1)
+        obj = a1.find()[0]
+        del db.statements[:]
+        other = obj.a2
+        self.assertTrue(obj.a2 is other)
+        self.assertEqual(len(db.statements), 1)
+        obj.column2 = 'row2_2'
+        self.assertFalse(obj.a2 is other)
+        self.assertEqual(len(db.statements), 2)
+        obj.a2 = other
+        self.assertTrue(obj.a2 is other)
+        obj.expire(a1.a2)
+        self.assertFalse(obj.a2 is other)
+        self.assertEqual(len(db.statements), 3)
+        obj.reload()
+        del db.statements[:]
+        obj.a2
+        self.assertEqual(len(db.statements), 1)
+
 
 class TestToMany(SqlTestCase):
     def setUp(self):
@@ -310,6 +361,23 @@ class TestToMany(SqlTestCase):
         obj = MyModel()
         self.assertTrue(isinstance(obj.some_models[0], SomeModel))
 
+    def test_memoize(self):
+        db = connection.connect(':memory:')
+        db.rows = [('row1_1', 'row1_2')]
+        a1 = SomeModel.as_alias('m1')
+        a2 = SomeModel.as_alias('m2')
+        a1.a2 = ToMany(a1.column1, a2.column2)
+        obj = a1.find()[0]
+        del db.statements[:]
+        res = obj.a2
+        self.assertTrue(obj.a2 is res)
+        self.assertEqual(len(res), 1)
+        self.assertTrue(res[0] is list(res)[0])
+        self.assertEqual(len(db.statements), 1)
+        self.assertFalse(isinstance(res.order_by(a2.column1), RelatedSelect))
+        obj.expire()
+        self.assertFalse(obj.a2 is res)
+
 
 class TestManyToMany(SqlTestCase):
     def setUp(self):
@@ -517,6 +585,214 @@ class TestModelActions(SqlTestCase):
     def tearDown(self):
         connection.sqlite3 = sys.modules['sqlite3']
 
+    def test_insert_many(self):
+        db = connection.connect(':memory:')
+        db.lastrowid = 1
+        obj = SomeModelAdapterConverter()
+        obj.column1 = 'a'
+        rows = [obj, dict(column1='b'), dict(column1='c', column2='d')]
+        self.assertEqual(SomeModelAdapterConverter.insert_many(rows), 3)
+        # the instance's group runs row by row to learn its oid
+        self.assertEqual(db.statements, [
+            ('insert into "some_table" ("some_column") values (?)', ('A',)),
+            ('insert into "some_table" ("some_column") values (?)', ('B',)),
+        ])
+        self.assertEqual(db.many_statements, [
+            ('insert into "some_table" ("some_column", "other_column") '
+             'values (?, ?)', [('C', 'd')]),
+        ])
+        self.assertEqual(db.commits, 1)
+        self.assertFalse(obj.orm_new)
+        self.assertColumnEqual(obj.oid, 1)
+        self.assertEqual(obj.orm_dirty, {})
+        self.assertRaises(
+            TypeError, SomeModel.insert_many, [dict(column3='x')])
+
+    def test_upsert_many(self):
+        db = connection.connect(':memory:')
+        rows = [dict(column1='a', column2='b'), dict(column1='c')]
+        self.assertEqual(SomeModel.upsert_many(rows), 2)
+        self.assertEqual(db.many_statements, [
+            ('insert into "some_table" ("some_column", "other_column") '
+             'values (?, ?) on conflict ("some_column") do update set '
+             '"other_column" = excluded."other_column"', [('a', 'b')]),
+            ('insert into "some_table" ("some_column") values (?) '
+             'on conflict ("some_column") do nothing', [('c',)]),
+        ])
+        self.assertEqual(db.commits, 1)
+        del db.many_statements[:]
+        SomeModel.upsert_many(
+            rows[:1], conflict=[SomeModel.column2], update=[SomeModel.column1])
+        self.assertEqual(db.many_statements, [
+            ('insert into "some_table" ("some_column", "other_column") '
+             'values (?, ?) on conflict ("other_column") do update set '
+             '"some_column" = excluded."some_column"', [('a', 'b')]),
+        ])
+        self.assertRaises(
+            TypeError, SomeModelNoPrimaries.upsert_many, rows)
+        version = sqlite3.sqlite_version_info
+        sqlite3.sqlite_version_info = (3, 23, 0)
+        try:
+            self.assertRaises(RuntimeError, SomeModel.upsert_many, rows)
+        finally:
+            sqlite3.sqlite_version_info = version
+
+    def test_upsert_many_instances_get_keys(self):
+        db = connection.connect(':memory:')
+        db.lastrowid = 1
+        db.rows = [(7,)]
+        obj = SomeModelNoPrimaries()
+        obj.column1 = 'a'
+        obj.column2 = 'b'
+        SomeModelNoPrimaries.upsert_many(
+            [obj], conflict=[SomeModelNoPrimaries.column1])
+        self.assertEqual(db.statements, [
+            ('insert into "some_table" ("some_column", "other_column") '
+             'values (?, ?) on conflict ("some_column") do update set '
+             '"other_column" = excluded."other_column"', ('a', 'b')),
+            ('select "some_table"."oid" from "some_table" '
+             'where "some_table"."some_column" = ?', ('a',)),
+        ])
+        self.assertColumnEqual(obj.oid, 7)
+        self.assertFalse(obj.orm_new)
+
+    def test_insert_many_chunk(self):
+        db = connection.connect(':memory:')
+        SomeModel.insert_many(
+            (dict(column1=i) for i in xrange(5)), chunk=2)
+        self.assertEqual(
+            [args for sql, args in db.many_statements],
+            [[(0,), (1,)], [(2,), (3,)], [(4,)]])
+        self.assertEqual(db.commits, 1)
+
+    def test_insert_many_assign_keys(self):
+        db = connection.connect(':memory:')
+        db.lastrowid = 7
+        objs = [SomeModelNoPrimaries(), SomeModelNoPrimaries()]
+        for obj in objs:
+            obj.column1 = 'a'
+        SomeModelNoPrimaries.insert_many(objs, assign_keys=True)
+        self.assertEqual(db.statements, [
+            ('insert into "some_table" ("some_column") values (?)',
+             ('a',)),
+        ] * 2)
+        for obj in objs:
+            self.assertColumnEqual(obj.oid, 7)
+            self.assertFalse(obj.orm_new)
+
+    def test_insert_many_instances_get_keys(self):
+        db = connection.connect(':memory:')
+        db.lastrowid = 7
+        obj = SomeModelNoPrimaries()
+        obj.column1 = 'a'
+        SomeModelNoPrimaries.insert_many([obj])
+        self.assertEqual(db.many_statements, [])
+        self.assertColumnEqual(obj.oid, 7)
+        del db.statements[:]
+        obj.column2 = 'b'
+        obj.save()
+        obj.delete()
+        self.assertEqual(db.statements, [
+            ('update "some_table" set "other_column" = ? '
+             'where "some_table"."oid" = ?', ('b', 7)),
+            ('delete from "some_table" where "some_table"."oid" = ?', (7,)),
+        ])
+        obj = SomeModel()
+        obj.column1 = 'a'
+        SomeModel.insert_many([obj])
+        self.assertEqual(db.many_statements, [
+            ('insert into "some_table" ("some_column") values (?)', [('a',)]),
+        ])
+
+    def test_save_reload_none(self):
+        db = connection.connect(':memory:')
+        db.lastrowid = 3
+        obj = SomeModelNoPrimaries()
+        obj.column1 = 'a'
+        obj.save(reload='none')
+        self.assertEqual(db.statements, [
+            ('insert into "some_table" ("some_column") values (?)', ('a',)),
+        ])
+        self.assertColumnEqual(obj.oid, 3)
+        self.assertFalse(obj.orm_new)
+        self.assertEqual(obj.orm_dirty, {})
+        self.assertRaises(ValueError, SomeModel().save, reload='some')
+
+    def test_save_reload_defaults(self):
+        class WithDefault(Model):
+            orm_table = 'some_table'
+            column1 = Column('some_column', primary=True)
+            column2 = Column('other_column', db_default=True)
+            orm_reload = 'defaults'
+            orm_rowid_alias = True
+
+        db = connection.connect(':memory:')
+        db.lastrowid = 3
+        db.rows = [('default',)]
+        obj = WithDefault()
+        obj.save()
+        self.assertEqual(db.statements, [
+            ('insert into "some_table" default values', ()),
+            ('select "some_table"."other_column" from "some_table" '
+             'where "some_table"."oid" = ?', (3,)),
+        ])
+        self.assertColumnEqual(obj.column1, 3)
+        self.assertColumnEqual(obj.column2, 'default')
+        obj = WithDefault()
+        obj.column1 = 'a'
+        obj.column2 = 'b'
+        del db.statements[:]
+        obj.save()
+        self.assertEqual(len(db.statements), 1)
+        self.assertColumnEqual(obj.column1, 'a')
+        self.assertColumnEqual(obj.oid, 3)
+
+    def test_save_reload_primary_not_rowid(self):
+        class TextKey(Model):
+            orm_table = 'some_table'
+            column1 = Column('some_column', primary=True)
+
+        db = connection.connect(':memory:')
+        db.lastrowid = 3
+        db.rows = [(0, 'some_column', 'TEXT', 0, "'x'", 1)]
+        for i in xrange(2):
+            TextKey().save(reload='none')
+        self.assertEqual(db.statements, [
+            ('insert into "some_table" default values', ()),
+            ('pragma table_info("some_table")', ()),
+            ('select "some_table"."some_column" from "some_table" '
+             'where "some_table"."oid" = ?', (3,)),
+        ] + [
+            ('insert into "some_table" default values', ()),
+            ('select "some_table"."some_column" from "some_table" '
+             'where "some_table"."oid" = ?', (3,)),
+        ])
+        self.assertFalse(TextKey.orm_rowid_alias)
+
+    def test_save_reload_returning(self):
+        db = connection.connect(':memory:')
+        db.lastrowid = 1
+        db.rows = [('hello', 'world', 1)]
+        version = sqlite3.sqlite_version_info
+        sqlite3.sqlite_version_info = (3, 35, 0)
+        try:
+            obj = SomeModel()
+            obj.column1 = 'hello'
+            obj.save(reload='returning')
+        finally:
+            sqlite3.sqlite_version_info = version
+        self.assertEqual(db.statements, [(
+            'insert into "some_table" ("some_column") values (?) '
+            'returning "some_column", "other_column", "oid"', ('hello',))])
+        self.assertColumnEqual(obj.column2, 'world')
+        self.assertColumnEqual(obj.oid, 1)
+        del db.statements[:]
+        obj = SomeModel()
+        obj.column1 = 'hello'
+        obj.save(reload='returning')
+        self.assertEqual(len(db.statements), 2)
+        self.assertFalse('returning' in db.statements[0][0])
+
     def test_save_insert(self):
         db = connection.connect(':memory:')
         db.lastrowid = 1
@@ -662,6 +938,67 @@ class TestModelActions(SqlTestCase):
         self.assertEqual(obj.orm_dirty, {})
         self.assertEqual(db.statements, [])
 
+    def test_save_update_unchanged(self):
+        db = connection.connect(':memory:')
+        obj = SomeModel()
+        obj.orm_new = False
+        obj.__dict__['column1'] = 'old1'
+        obj.__dict__['column2'] = 'old2'
+        unchanged = write_stats['unchanged']
+        skipped = write_stats['skipped_saves']
+        obj.column1 = 'old1'
+        obj.column2 = 'new2'
+        obj.column2 = 'old2'
+        self.assertEqual(obj.orm_dirty, {})
+        obj.save()
+        self.assertEqual(db.statements, [])
+        self.assertEqual(write_stats['unchanged'], unchanged + 2)
+        self.assertEqual(write_stats['skipped_saves'], skipped + 1)
+
+    def test_save_update_unchanged_partial(self):
+        db = connection.connect(':memory:')
+        obj = SomeModel()
+        obj.orm_new = False
+        obj.__dict__['column1'] = 'old1'
+        obj.__dict__['column2'] = 'old2'
+        obj.column1 = 'old1'
+        obj.column2 = 'new2'
+        obj.save()
+        self.assertEqual(db.statements, [
+            (
+                'update "some_table" set "other_column" = ? '
+                'where "some_table"."some_column" = ?',
+                ('new2', 'old1')
+            ),
+        ])
+
+    def test_update_unchanged_column_adapter(self):
+        db = connection.connect(':memory:')
+        obj = SomeModelAdapterConverter()
+        obj.orm_new = False
+        obj.__dict__['oid'] = 1
+        obj.__dict__['column1'] = 'a string'
+        obj.column1 = 'A String'
+        self.assertEqual(obj.orm_dirty, {})
+        items = []
+        obj.__dict__['column2'] = items
+        obj.column2 = items
+        self.assertEqual(obj.orm_dirty, {SomeModelAdapterConverter.column2: items})
+        obj.save()
+        self.assertEqual(db.statements, [
+            (
+                'update "some_table" set "other_column" = ? '
+                'where "some_table"."oid" = ?',
+                ([], 1)
+            ),
+        ])
+
+    def test_save_insert_unchanged(self):
+        obj = SomeModel()
+        obj.__dict__['column1'] = 'hello'
+        obj.column1 = 'hello'
+        self.assertEqual(obj.orm_dirty, {SomeModel.column1: 'hello'})
+
     def test_delete_new(self):
         db = connection.connect(':memory:')
         obj = SomeModel()
@@ -736,6 +1073,36 @@ class TestModelActions(SqlTestCase):
             )]
         )
 
+    def test_get(self):
+        db = connection.connect(':memory:')
+        db.rows = [('row1_1', 'row1_2')]
+        obj = SomeSubclass.get('a', 'b')
+        self.assertTrue(isinstance(obj, SomeSubclass))
+        self.assertFalse(obj.orm_new)
+        self.assertColumnEqual(obj.column1, 'row1_1')
+        self.assertEqual(db.statements, [(
+            'select "some_table"."some_column", '
+            '"some_table"."other_column", '
+            '"some_table"."oid", '
+            '"some_table"."third_column" '
+            'from "some_table" '
+            'where ("some_table"."some_column" = ?) '
+            'and ("some_table"."third_column" = ?) '
+            'limit 0, 1',
+            ('a', 'b')
+        )])
+        db.rows = []
+        self.assertEqual(SomeSubclass.get('a', 'c'), None)
+        self.assertRaises(TypeError, SomeSubclass.get, 'a')
+
+    def test_get_oid(self):
+        db = connection.connect(':memory:')
+        SomeModelNoPrimaries.get(5)
+        self.assertEqual(db.statements[0][1], (5,))
+        self.assertTrue(
+            db.statements[0][0].endswith('where "some_table"."oid" = ? '
+                                         'limit 0, 1'))
+
     def test_reload_with_converter(self):
         db = connection.connect(':memory:')
         connection.get_connection().rows = rows = [
@@ -789,6 +1156,284 @@ class TestModelSelect(SqlTestCase):
             self.assertColumnEqual(obj.column1, row[0])
             self.assertColumnEqual(obj.column2, row[1].upper())
 
+    def test_hydrator(self):
+        hydrate = SomeModelAdapterConverter.find()._hydrator()
+        self.assertTrue(
+            SomeModelAdapterConverter.find(Sql('1'))._hydrator() is hydrate)
+        obj = hydrate(('a', 'b', 1))
+        self.assertTrue(isinstance(obj, SomeModelAdapterConverter))
+        self.assertFalse(obj.orm_new)
+        self.assertEqual(obj.orm_dirty, {})
+        self.assertColumnEqual(obj.column1, 'a')
+        self.assertColumnEqual(obj.column2, 'B')
+        self.assertColumnEqual(obj.oid, 1)
+
+    def test_hydrator_join(self):
+        q = ModelSelect(ExprList([SomeModel.column1, SomeModelSomeModel.oid,
+                                  SomeModel.column2]))
+        one, other = q._hydrator()(('a', 1, 'b'))
+        self.assertTrue(isinstance(one, SomeModel))
+        self.assertTrue(isinstance(other, SomeModelSomeModel))
+        self.assertColumnEqual(one.column1, 'a')
+        self.assertColumnEqual(one.column2, 'b')
+        self.assertColumnEqual(other.oid, 1)
+
+    def test_hydrator_set_from_db(self):
+        class LowerColumn(Column):
+            def set_from_db(self, obj, value):
+                obj.__dict__[self.attr] = value.lower()
+
+        class Lower(Model):
+            column = LowerColumn()
+
+        obj = Lower.find()._hydrator()((1, 'A'))
+        self.assertColumnEqual(obj.column, 'a')
+        self.assertColumnEqual(obj.oid, 1)
+
+    def test_values(self):
+        db = connection.connect(':memory:')
+        db.rows = [('a', 'b', 1), ('c', 'd', 2)]
+        q = SomeModelAdapterConverter.find()
+        self.assertEqual(list(q.tuples()), [('a', 'B', 1), ('c', 'D', 2)])
+        self.assertEqual(list(q.dicts()), [
+            dict(column1='a', column2='B', oid=1),
+            dict(column1='c', column2='D', oid=2),
+        ])
+        db.rows = [('b', 'a'), ('d', 'c')]
+        q = q.find(SomeModelAdapterConverter.column1 == 'x')
+        values = q.values(SomeModelAdapterConverter.column2,
+                          SomeModelAdapterConverter.column1)
+        self.assertTrue(isinstance(values, TupleSelect))
+        self.assertEqual(list(iter(values)), [('B', 'a'), ('D', 'c')])
+        self.assertEqual(db.statements[-1], (
+            'select "some_table"."other_column", "some_table"."some_column" '
+            'from "some_table" where "some_table"."some_column" = ?',
+            ('x',)))
+        self.assertEqual(
+            list(values.order_by(SomeModelAdapterConverter.column1)),
+            [('B', 'a'), ('D', 'c')])
+
+    def test_scalars(self):
+        db = connection.connect(':memory:')
+        db.rows = [('a',), ('b',)]
+        q = SomeModelAdapterConverter.find()
+        self.assertEqual(
+            list(q.scalars(SomeModelAdapterConverter.column2)), ['A', 'B'])
+        self.assertEqual(
+            list(iter(q.scalars(SomeModelAdapterConverter.column1))),
+            ['a', 'b'])
+        self.assertEqual(db.statements[-1], (
+            'select "some_table"."some_column" from "some_table"', ()))
+
+    def test_deferred(self):
+        db = connection.connect(':memory:')
+        self.assertItemsIdentical(
+            SomeModelDeferred.orm_default_columns,
+            (SomeModelDeferred.oid, SomeModelDeferred.column1))
+        db.rows = [(1, 'a')]
+        obj = SomeModelDeferred.find()[0]
+        self.assertTrue(isinstance(obj, SomeModelDeferred))
+        self.assertFalse('SomeModelDeferred_deferred' in REGISTERED_MODELS)
+        self.assertEqual(db.statements[-1], (
+            'select "some_table"."oid", "some_table"."some_column" '
+            'from "some_table" limit 0, 1', ()))
+        self.assertTrue(SomeModelDeferred.column2 is
+                        obj.__class__.column2)
+        db.rows = [('b',)]
+        self.assertColumnEqual(obj.column2, 'b')
+        self.assertColumnEqual(obj.column2, 'b')
+        self.assertEqual(db.statements[-1], (
+            'select "some_table"."other_column" from "some_table" '
+            'where "some_table"."oid" = ? limit 0, 1', (1,)))
+        self.assertEqual(len(db.statements), 2)
+        obj.column2 = 'c'
+        self.assertColumnEqual(obj.column2, 'c')
+        self.assertEqual(obj.orm_dirty, {SomeModelDeferred.column2: 'b'})
+
+    def test_only_defer(self):
+        db = connection.connect(':memory:')
+        db.rows = [('a', 1)]
+        q = SomeModel.find()
+        self.assertSqlEqual(
+            q.defer(SomeModel.column2).order_by(SomeModel.column1),
+            'select "some_table"."some_column", "some_table"."oid" '
+            'from "some_table" order by "some_table"."some_column"')
+        self.assertSqlEqual(
+            q.only(SomeModel.oid),
+            'select "some_table"."some_column", "some_table"."oid" '
+            'from "some_table"')
+        self.assertSqlEqual(
+            SomeModelDeferred.find().only(SomeModelDeferred.column2),
+            'select "some_table"."oid", "some_table"."other_column" '
+            'from "some_table"')
+        self.assertRaises(TypeError, q.defer, SomeModel.column2, bad=True)
+
+    def test_batch_load(self):
+        db = connection.connect(':memory:')
+        db.rows = [(1, 'a'), (2, 'b')]
+        objs = list(iter(SomeModelDeferred.find().defer(batch=True)))
+        self.assertEqual(len(db.statements), 1)
+        db.rows = [(2, 'y'), (1, 'x')]
+        self.assertColumnEqual(objs[0].column2, 'x')
+        self.assertColumnEqual(objs[1].column2, 'y')
+        self.assertEqual(db.statements[-1], (
+            'select "some_table"."oid", "some_table"."other_column" '
+            'from "some_table" where "some_table"."oid" in (?, ?)', (1, 2)))
+        self.assertEqual(len(db.statements), 2)
+
+    def test_join_load(self):
+        db = connection.connect(':memory:')
+        SomeModelSomeModel.m1 = ToOne(
+            SomeModelSomeModel.m1_column1, SomeModel.column1)
+        try:
+            q = SomeModelSomeModel.find().join_load(SomeModelSomeModel.m1)
+            db.rows = [
+                (1, 'b', 'a', 'a', 'c', 2),
+                (3, 'y', 'x', None, None, None),
+            ]
+            objs = list(iter(q))
+            self.assertEqual(db.statements, [(
+                'select "some_table_some_table"."oid", '
+                '"some_table_some_table"."m2_column1", '
+                '"some_table_some_table"."m1_column1", '
+                '"some_table"."some_column", "some_table"."other_column", '
+                '"some_table"."oid" '
+                'from "some_table_some_table" left join "some_table" on '
+                '"some_table"."some_column" = '
+                '"some_table_some_table"."m1_column1"', ())])
+            self.assertTrue(isinstance(objs[0], SomeModelSomeModel))
+            self.assertTrue(isinstance(objs[0].m1, SomeModel))
+            self.assertColumnEqual(objs[0].m1.column2, 'c')
+            self.assertTrue(objs[1].m1 is None)
+            self.assertEqual(len(db.statements), 1)
+            objs[0].m1_column1 = 'z'
+            db.rows = []
+            self.assertTrue(objs[0].m1 is None)
+            self.assertEqual(len(db.statements), 2)
+        finally:
+            del SomeModelSomeModel.m1
+
+    def test_join_load_alias(self):
+        q = SomeModel.find().join_load(
+            ToOne(SomeModel.column2, SomeModel.column1))
+        self.assertSqlEqual(
+            q.only(SomeModel.column1),
+            'select "some_table"."some_column", '
+            '"some_table_column2"."some_column" '
+            'from "some_table" left join "some_table" "some_table_column2" '
+            'on "some_table_column2"."some_column" = '
+            '"some_table"."other_column"')
+
+    def test_prefetch(self):
+        db = connection.connect(':memory:')
+        db.rows = [('a', 'a', 1), ('b', 'a', 2)]
+        children = ToMany(SomeModel.column1, SomeModel.column2)
+        parent = ToOne(SomeModel.column2, SomeModel.column1)
+        objs = list(iter(SomeModel.find().prefetch(children, parent)))
+        self.assertEqual(db.statements[1:], [
+            ('select "some_table"."some_column", '
+             '"some_table"."other_column", "some_table"."oid" '
+             'from "some_table" where "some_table"."other_column" in (?, ?)',
+             ('a', 'b')),
+            ('select "some_table"."some_column", '
+             '"some_table"."other_column", "some_table"."oid" '
+             'from "some_table" where "some_table"."some_column" in (?)',
+             ('a',)),
+        ])
+        del db.statements[:]
+        first = children.__get__(objs[0], SomeModel)
+        self.assertTrue(isinstance(first, RelatedSelect))
+        self.assertEqual([obj.column1 for obj in first], ['a', 'b'])
+        self.assertEqual(list(children.__get__(objs[1], SomeModel)), [])
+        self.assertColumnEqual(parent.__get__(objs[1], SomeModel).column1, 'a')
+        self.assertEqual(db.statements, [])
+
+    def test_prefetch_batches(self):
+        db = connection.connect(':memory:')
+        db.rows = [('a', 'a', 1), ('b', 'a', 2)]
+        children = ToMany(SomeModel.column1, SomeModel.column2)
+        q = SomeModel.find().prefetch(children)
+        batches = list(q.iter_batches(1))
+        self.assertEqual(map(len, batches), [1, 1])
+        self.assertEqual([args for sql, args in db.statements[1:]], [
+            ('a',), ('b',)])
+
+    def test_update(self):
+        db = connection.connect(':memory:')
+        db.rowcount = 2
+        q = SomeModelAdapterConverter.find(
+            SomeModelAdapterConverter.column2 == 'x')
+        self.assertEqual(q.update(
+            column2=SomeModelAdapterConverter.column2 + 1, column1='a'), 2)
+        self.assertEqual(db.statements, [(
+            'update "some_table" set "some_column" = ?, "other_column" = '
+            '"some_table"."other_column" + ? '
+            'where "some_table"."other_column" = ?', ('A', 1, 'x'))])
+        self.assertEqual(q.update(), 0)
+        self.assertRaises(TypeError, q.update, column3=1)
+        self.assertRaises(TypeError, q[:1].update, column1=1)
+        self.assertRaises(
+            TypeError, q.join_load(ToOne(SomeModelAdapterConverter.column2,
+                                         SomeModel.column1)).update,
+            column1=1)
+
+    def test_fetch(self):
+        db = connection.connect(':memory:')
+        db.rows = [('row1_1', 'row1_2'), ('row2_1', 'row2_2')]
+        res = SomeModel.find().fetch()
+        self.assertEqual(len(res), 2)
+        self.assertTrue(res[0] is iter(res).next())
+        self.assertTrue(isinstance(res[1], SomeModel))
+        self.assertEqual(len(db.statements), 1)
+
+    def test_iter_batches(self):
+        db = connection.connect(':memory:')
+        db.rows = [('row%d_1' % i, 'row%d_2' % i) for i in xrange(3)]
+        batches = list(SomeModel.find().iter_batches(2))
+        self.assertEqual(map(len, batches), [2, 1])
+        for obj, row in zip(batches[0] + batches[1], db.rows):
+            self.assertTrue(isinstance(obj, SomeModel))
+            self.assertColumnEqual(obj.column1, row[0])
+            self.assertColumnEqual(obj.column2, row[1])
+        self.assertEqual(db.fetches, [2, 2, 2])
+
+    def test_scan(self):
+        db = connection.connect(':memory:')
+        db.rows = [('row1_1', 'row1_2'), ('row2_1', 'row2_2')]
+        objs = list(SomeModel.scan(chunk=3, where=SomeModel.column1 == 'x'))
+        self.assertEqual([obj.column1 for obj in objs], ['row1_1', 'row2_1'])
+        self.assertEqual(db.statements, [(
+            'select "some_table"."some_column", '
+            '"some_table"."other_column", "some_table"."oid" '
+            'from "some_table" where "some_table"."some_column" = ? '
+            'order by "some_table"."some_column" limit 3', ('x',))])
+
+    def test_scan_releases_reader(self):
+        router = connection.set_pool(connection.Router('some.db', readers=1))
+        reader = router.readers.checkout()
+        router.readers.checkin(reader)
+        reader.rows = [('row1_1', 'row1_2'), ('row2_1', 'row2_2')]
+        for obj in SomeModel.scan(chunk=3):
+            self.assertEqual(router.readers.leased(), None)
+            self.assertEqual([c for c, t in router.readers.idle], [reader])
+        self.assertEqual(router.writer.size, 0)
+        self.assertEqual(len(reader.statements), 2)
+
+    def test_paginate(self):
+        db = connection.connect(':memory:')
+        db.rows = [('row1_1', 'row1_2'), ('row2_1', 'row2_2')]
+        q = SomeModelAdapterConverter.find()
+        page = q.paginate(SomeModelAdapterConverter.column1, 1)
+        self.assertEqual(len(page), 1)
+        q.paginate(SomeModelAdapterConverter.column1, 1, page.token)
+        self.assertEqual(db.statements[-1], (
+            'select "some_table"."some_column", "some_table"."other_column", '
+            '"some_table"."oid" from "some_table" '
+            'where "some_table"."some_column" > ? '
+            'order by "some_table"."some_column" limit 2',
+            (u'ROW1_1',)
+        ))
+
     def test_join(self):
         connection.connect(':memory:')
         connection.get_connection().rows = rows = [
@@ -806,5 +1451,72 @@ class TestModelSelect(SqlTestCase):
             self.assertColumnEqual(obj.column2, 'row1_2')
 
 
+class TestSession(SqlTestCase):
+    def setUp(self):
+        connection.sqlite3 = sqlite3
+        sqlite3.reset()
+        connection.reset()
+        self.db = connection.connect(':memory:')
+        self.db.rows = [('a', 'b', 1)]
+
+    def tearDown(self):
+        connection.sqlite3 = sys.modules['sqlite3']
+
+    def test_scope(self):
+        self.assertTrue(current_session() is None)
+        with Session() as session:
+            self.assertTrue(current_session() is session)
+            with Session() as inner:
+                self.assertTrue(current_session() is inner)
+            self.assertTrue(current_session() is session)
+        self.assertTrue(current_session() is None)
+
+    def test_identity(self):
+        self.assertFalse(SomeModel.find()[0] is SomeModel.find()[0])
+        with Session() as session:
+            obj = SomeModel.find()[0]
+            self.assertTrue(SomeModel.find()[0] is obj)
+            self.assertTrue(iter(SomeModel.find()).next() is obj)
+            self.assertTrue(session.get(SomeModel, ('a',)) is obj)
+            self.assertEqual(len(session), 1)
+
+    def test_weak(self):
+        with Session() as session:
+            SomeModel.find()[0]
+            gc.collect()
+            self.assertEqual(len(session), 0)
+
+    def test_get(self):
+        with Session():
+            obj = SomeModel.find()[0]
+            del self.db.statements[:]
+            self.assertTrue(SomeModel.get('a') is obj)
+            self.assertEqual(self.db.statements, [])
+
+    def test_to_one(self):
+        SomeModelSomeModel.m1 = ToOne(
+            SomeModelSomeModel.m1_column1, SomeModel.column1)
+        try:
+            with Session():
+                obj = SomeModel.find()[0]
+                other = SomeModelSomeModel()
+                other.m1_column1 = 'a'
+                del self.db.statements[:]
+                self.assertTrue(other.m1 is obj)
+                self.assertEqual(self.db.statements, [])
+        finally:
+            del SomeModelSomeModel.m1
+
+    def test_save_delete(self):
+        self.db.lastrowid = 1
+        with Session() as session:
+            obj = SomeModel()
+            obj.column1 = 'a'
+            obj.save()
+            self.assertTrue(session.get(SomeModel, ('a',)) is obj)
+            obj.delete()
+            self.assertTrue(session.get(SomeModel, ('a',)) is None)
+
+
 if __name__ == "__main__":
     main(__name__)
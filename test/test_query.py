@@ -1,4 +1,5 @@
 import sys
+import json
 import unittest
 
 from .util import *
@@ -69,6 +70,22 @@ class TestExpr(SqlTestCase):
             self.assertTrue(isinstance(res, cls))
             self.assertTrue(res.value is expr)
 
+    def test_compile(self):
+        q = Select(Sql('x'), Sql('t'), (Sql('x') == 1) & (Sql('y') == 2))
+        self.assertEqual(
+            q.compile(),
+            ('select x from t where (x = ?) and (y = ?)', (1, 2))
+        )
+
+    def test_compile_duck_typed_value(self):
+        class Raw(object):
+            def sql(self):
+                return 'raw'
+            def args(self):
+                return (1,)
+        self.assertSqlEqual(Expr(Raw()) + 2, 'raw + ?', (1, 2))
+        self.assertSqlEqual(Select(Sql('x'), Raw()), 'select x from raw', (1,))
+
     def test_eq_null(self):
         expr = (Expr(1) == None)
         self.assertTrue(isinstance(expr, IsNull))
@@ -101,6 +118,68 @@ class TestExprExecute(unittest.TestCase):
         self.assertEqual(db.many_statements, [('? + ?', [(1, 2), (3, 4)])])
         self.assertTrue(isinstance(cur, sqlite3.Cursor))
 
+    def test_execute_routing(self):
+        router = connection.set_pool(connection.Router('some.db'))
+        Select(1).execute()
+        Insert(Sql('some_table')).execute()
+        self.assertEqual(router.readers.leased(), None)
+        reader = router.readers.checkout()
+        writer = router.writer.checkout()
+        self.assertEqual(reader.statements[-1], ('select ?', (1,)))
+        self.assertEqual(
+            writer.statements[-1],
+            ('insert into some_table default values', ())
+        )
+        self.assertEqual(writer.commits, 1)
+
+
+class TestPrepared(SqlTestCase):
+    def setUp(self):
+        connection.sqlite3 = sqlite3
+        sqlite3.reset()
+        connection.reset()
+
+    def tearDown(self):
+        connection.sqlite3 = sys.modules['sqlite3']
+
+    def test_param(self):
+        param = Param('x')
+        self.assertSqlEqual(Sql('a') == param, 'a = ?', (param,))
+
+    def test_prepare(self):
+        db = connection.connect(':memory:')
+        q = Select(Sql('a'), Sql('t'), (Sql('b') == Param('b')) & (
+            Sql('c') == 3) & (Sql('d') == Param('b')))
+        statement = q.prepare()
+        self.assertTrue(isinstance(statement, Prepared))
+        statement.execute(b=1)
+        statement.execute(b=2)
+        sql = 'select a from t where (b = ?) and (c = ?) and (d = ?)'
+        self.assertEqual(db.statements, [(sql, (1, 3, 1)), (sql, (2, 3, 2))])
+        self.assertRaises(TypeError, statement.execute)
+
+    def test_many(self):
+        db = connection.connect(':memory:')
+        statement = Insert(
+            Sql('t'), ExprList([Sql('a'), Sql('b')]),
+            ExprList([Param('a'), 0])
+        ).prepare()
+        statement.many([dict(a=1), dict(a=2)])
+        sql, args = db.many_statements[0]
+        self.assertEqual(sql, 'insert into t (a, b) values (?, ?)')
+        self.assertEqual(list(args), [(1, 0), (2, 0)])
+
+    def test_call(self):
+        db = connection.connect(':memory:')
+        db.rows = rows = [(1,), (2,)]
+        statement = Select(Sql('a'), Sql('t'), Sql('a') > Param('a')).prepare()
+        self.assertEqual(list(statement(a=0)), rows)
+        self.assertEqual(statement.first(a=0), (1,))
+        db.rows = []
+        self.assertEqual(statement.first(a=0), None)
+        cur = (Sql('a') + Param('a')).prepare()(a=1)
+        self.assertTrue(isinstance(cur, sqlite3.Cursor))
+
 
 class TestUnaryOps(SqlTestCase):
     def test_unary_ops(self):
@@ -146,6 +225,106 @@ class TestBinaryOps(SqlTestCase):
             self.assertSqlEqual(inst, '? %s (not ?)' % (op,), (1, 2))
 
 
+class TestNaryOps(SqlTestCase):
+    def test_flatten(self):
+        exprs = [Expr(i) == i for i in xrange(4)]
+        for cls, op, method_name in (
+            (And, 'and', '__and__'),
+            (Or, 'or', '__or__'),
+        ):
+            inst = reduce(getattr(Expr, method_name), exprs)
+            self.assertTrue(isinstance(inst, cls))
+            self.assertItemsIdentical(inst.values, exprs)
+            self.assertSqlEqual(
+                inst,
+                (' %s ' % (op,)).join(['(? = ?)'] * 4),
+                (0, 0, 1, 1, 2, 2, 3, 3)
+            )
+            inst = cls(exprs[0], cls(*exprs[1:]))
+            self.assertItemsIdentical(inst.values, exprs)
+
+    def test_merge_does_not_modify_operands(self):
+        a = Sql('a') & Sql('b')
+        b = a & Sql('c')
+        self.assertSqlEqual(a, 'a and b')
+        self.assertSqlEqual(b, 'a and b and c')
+
+    def test_mixed(self):
+        self.assertSqlEqual(
+            (Sql('a') | Sql('b')) & Sql('c') & (Sql('d') | Sql('e')),
+            '(a or b) and c and (d or e)'
+        )
+
+    def test_operands(self):
+        inst = And(1, 2, 3)
+        self.assertSqlEqual(inst.lvalue, '?', (1,))
+        self.assertSqlEqual(inst.rvalue, '? and ?', (2, 3))
+        self.assertRaises(TypeError, And, 1)
+
+    def test_many_predicates(self):
+        where = Sql('x') == 0
+        for i in xrange(1, 2000):
+            where = where | (Sql('x') == i)
+        self.assertEqual(len(where.values), 2000)
+        sql, args = Select(Sql('*'), Sql('t'), where).compile()
+        self.assertEqual(args, tuple(range(2000)))
+        self.assertEqual(sql.count(' or '), 1999)
+
+
+class TestIn(SqlTestCase):
+    def test_bucket(self):
+        self.assertSqlEqual(
+            Sql('x').isin([1, 2, 3]), 'x in (?, ?, ?, ?)', (1, 2, 3, 3))
+        self.assertSqlEqual(
+            Sql('x').isin(iter([1, 2, 3, 4])),
+            'x in (?, ?, ?, ?)', (1, 2, 3, 4)
+        )
+        self.assertSqlEqual(Sql('x').isin((1,)), 'x in (?)', (1,))
+        self.assertSqlEqual(Sql('x').isin([]), 'x in ()')
+
+    def test_expand(self):
+        self.assertSqlEqual(
+            Sql('x').isin(InList([1, 2, 3], 'expand')),
+            'x in (?, ?, ?)', (1, 2, 3)
+        )
+
+    def test_json(self):
+        self.assertSqlEqual(
+            Sql('x').isin(InList([1, 'a', None], 'json')),
+            'x in (select value from json_each(?))', ('[1, "a", null]',)
+        )
+        values = range(InList.json_threshold + 1)
+        self.assertSqlEqual(
+            Sql('x').isin(values),
+            'x in (select value from json_each(?))', (json.dumps(values),)
+        )
+
+    def test_auto_keeps_non_json_values_bound(self):
+        values = [buffer('x')] * 3 + [buffer('y')] * 6
+        InList.json_threshold, json_threshold = 8, InList.json_threshold
+        try:
+            sql, args = Sql('x').isin(values).compile()
+            self.assertEqual(args, tuple(values) + (buffer('y'),) * 7)
+            values = ['\xff'] * 9
+            sql, args = Sql('x').isin(values).compile()
+            self.assertEqual(len(args), 16)
+        finally:
+            InList.json_threshold = json_threshold
+        self.assertRaises(
+            UnicodeDecodeError, InList(values, 'json').compile)
+
+    def test_expr_operands(self):
+        self.assertSqlEqual(
+            Sql('x').isin(ExprList([1, Sql('y')])), 'x in (?, y)', (1,))
+        self.assertSqlEqual(
+            Sql('x').isin(Select(Sql('y'), Sql('t'))),
+            'x in (select y from t)'
+        )
+
+    def test_unknown_strategy(self):
+        self.assertRaises(ValueError, InList([1], 'bogus').compile)
+
+
 class TestSql(SqlTestCase):
     def test_sql(self):
         sql = 'some raw sql string'
@@ -462,7 +641,7 @@ class TestSelect(SqlTestCase):
         )
         self.assertSqlEqual(
             q.find(Sql('other_column')),
-            'select ? where ((some_column = ?) and (? + ?)) and other_column',
+            'select ? where (some_column = ?) and (? + ?) and other_column',
             (0, 1, 2, 3)
         )
 
@@ -472,6 +651,56 @@ class TestSelect(SqlTestCase):
         q = MySelect(Sql('1'))
         self.assertTrue(isinstance(q.find(Sql('1')), MySelect))
 
+    def test_after(self):
+        a, b = Sql('a'), Sql('b')
+        q = Select(ExprList([a, b]), Sql('t'), Sql('c'))
+        self.assertSqlEqual(
+            q.after(a, 1),
+            'select a, b from t where c and (a > ?) order by a',
+            (1,)
+        )
+        self.assertSqlEqual(
+            q.after((a, b), (1, 2)),
+            'select a, b from t where c and ((a, b) > (?, ?)) order by a, b',
+            (1, 2)
+        )
+        self.assertSqlEqual(
+            q.after((Desc(a), Desc(b)), [1, 2]),
+            'select a, b from t where c and ((a, b) < (?, ?)) '
+            'order by a desc, b desc',
+            (1, 2)
+        )
+        self.assertRaises(TypeError, q.after, (a, Desc(b)), (1, 2))
+        self.assertRaises(TypeError, q.after, (a, b), (1,))
+
+    def test_paginate(self):
+        db = connection.connect(':memory:')
+        db.rows = [(1, 'x'), (2, 'y'), (3, 'z')]
+        a, b = Sql('a'), Sql('b')
+        q = Select(ExprList([a, b]), Sql('t'))
+        page = q.paginate((b, a), 2)
+        self.assertTrue(isinstance(page, Page))
+        self.assertEqual(page, db.rows[:2])
+        self.assertEqual(
+            db.statements[-1],
+            ('select a, b from t order by b, a limit 3', ())
+        )
+        db.rows = [(3, 'z')]
+        page = q.paginate((b, a), 2, page.token)
+        self.assertEqual(page, [(3, 'z')])
+        self.assertEqual(page.token, None)
+        self.assertEqual(db.statements[-1], (
+            'select a, b from t where (b, a) > (?, ?) '
+            'order by b, a limit 3',
+            (u'y', 2)
+        ))
+
+    def test_paginate_unselected_key(self):
+        db = connection.connect(':memory:')
+        db.rows = [(1,), (2,)]
+        q = Select(Sql('a'), Sql('t'))
+        self.assertRaises(TypeError, q.paginate, Sql('b'), 1)
+
     def test_delete(self):
         q = Select(
             Sql('1'),
@@ -488,6 +717,88 @@ class TestSelect(SqlTestCase):
         )
 
 
+class TestResultSet(unittest.TestCase):
+    def setUp(self):
+        connection.sqlite3 = sqlite3
+        sqlite3.reset()
+        connection.reset()
+        self.db = connection.connect(':memory:')
+        self.db.rows = self.rows = [(i,) for i in xrange(5)]
+
+    def tearDown(self):
+        connection.sqlite3 = sys.modules['sqlite3']
+
+    def test_fetch(self):
+        res = Select(sources=Sql('t')).fetch()
+        self.assertTrue(isinstance(res, ResultSet))
+        self.assertEqual(len(res), 5)
+        self.assertEqual(list(res), self.rows)
+        self.assertEqual(list(res), self.rows)
+        self.assertEqual(res[1], (1,))
+        self.assertEqual(res[-1], (4,))
+        self.assertEqual(res[1:3], self.rows[1:3])
+        self.assertEqual([res[i] for i in xrange(len(res))], self.rows)
+        self.assertRaises(IndexError, res.__getitem__, 5)
+        self.assertEqual(self.db.statements, [('select * from t', ())])
+
+    def test_cached_is_lazy(self):
+        res = Select(sources=Sql('t')).cached()
+        self.assertEqual(self.db.statements, [])
+        self.assertEqual(res[1], (1,))
+        self.assertEqual(res._rows, self.rows[:2])
+        self.assertTrue(res)
+        self.assertEqual(res[:3], self.rows[:3])
+        self.assertEqual(res._rows, self.rows[:3])
+        it = iter(res)
+        self.assertEqual([it.next() for i in xrange(4)], self.rows[:4])
+        self.assertEqual(res._rows, self.rows[:4])
+        self.assertEqual(list(it), self.rows[4:])
+        self.assertEqual(len(res), 5)
+        self.assertEqual(self.db.statements, [('select * from t', ())])
+
+    def test_empty(self):
+        self.db.rows = []
+        res = Select(sources=Sql('t')).cached()
+        self.assertFalse(res)
+        self.assertEqual(len(res), 0)
+        self.assertEqual(list(res), [])
+
+    def test_rows(self):
+        res = ResultSet(Select(sources=Sql('t')), [(1,)])
+        self.assertEqual(list(res), [(1,)])
+        self.assertEqual(self.db.statements, [])
+
+
+class TestBatches(unittest.TestCase):
+    def setUp(self):
+        connection.sqlite3 = sqlite3
+        sqlite3.reset()
+        connection.reset()
+        self.db = connection.connect(':memory:')
+        self.db.rows = self.rows = [(i,) for i in xrange(5)]
+
+    def tearDown(self):
+        connection.sqlite3 = sys.modules['sqlite3']
+
+    def test_iter_batches(self):
+        q = Select(sources=Sql('t'))
+        self.assertEqual(list(q.iter_batches(2)), [
+            self.rows[0:2], self.rows[2:4], self.rows[4:]])
+        self.assertEqual(self.db.fetches, [2, 2, 2, 2])
+        self.assertEqual(list(q.batched(3).iter_batches()), [
+            self.rows[0:3], self.rows[3:]])
+        self.assertEqual(self.db.fetches[4:], [3, 3, 3])
+
+    def test_batch_size(self):
+        q = Select(sources=Sql('t'), batch_size=2)
+        self.assertEqual(list(q), self.rows)
+        self.assertEqual(self.db.fetches, [2, 2, 2, 2])
+        self.assertEqual(q.find(Sql('1')).batch_size, 2)
+        self.assertEqual(q.order_by(Sql('1')).batch_size, 2)
+        self.assertEqual(q[1:].batch_size, 2)
+        self.assertEqual(Select(sources=Sql('t')).batch_size, None)
+
+
 class TestDelete(SqlTestCase):
     def test_delete(self):
         q = Delete(Sql('some_table'))
@@ -551,6 +862,32 @@ class TestInsert(SqlTestCase):
             (2,)
         )
 
+    def test_insert_on_conflict(self):
+        q = Insert(
+            Sql('some_table'),
+            ExprList([Sql('a'), Sql('b'), Sql('c')]),
+            ExprList([1, 2, 3]),
+            OnConflict(['a'], ['b', 'c']),
+        )
+        self.assertSqlEqual(
+            q,
+            'insert into some_table (a, b, c) values (?, ?, ?) '
+            'on conflict ("a") do update set '
+            '"b" = excluded."b", "c" = excluded."c"',
+            (1, 2, 3)
+        )
+        q.on_conflict = OnConflict(['a', 'b'])
+        self.assertSqlEqual(
+            q,
+            'insert into some_table (a, b, c) values (?, ?, ?) '
+            'on conflict ("a", "b") do nothing',
+            (1, 2, 3)
+        )
+        q.on_conflict = 'replace'
+        self.assertSqlEqual(
+            q, 'insert or replace into some_table (a, b, c) values (?, ?, ?)',
+            (1, 2, 3))
+
     def test_insert_default_values(self):
         q = Insert(Sql('some_table'))
         self.assertSqlEqual(q, 'insert into some_table default values')